@@ -0,0 +1,328 @@
+#!/usr/bin/python
+# -*- coding: iso-8859-1 -*-
+# create by: Massimo Di Pierro<mdipierro@cs.depaul.edu>
+# license: GPL2.0
+
+import os, sys, time, glob, json, random, shutil, struct, tempfile, platform
+from optparse import *
+import qcdutils_get
+from qcdutils_get import QCDFormat, OPTIONS, GaugeHot, Lime, \
+    GaugeMDP, GaugeILDG, GaugeMILC, GaugeNERSC, GaugeSCIDAC, \
+    PropagatorMDP, PropagatorSCIDAC
+
+usage = "qcdutils_bench.py [options]\n" \
+    "  Examples:\n" \
+    "    qcdutils_bench.py --sizes 8x8x8x8 --output before.json\n" \
+    "    qcdutils_bench.py --sizes 8x8x8x8 --compare before.json\n"
+
+version = "qcdutils_bench v1.0\n" \
+    "  Copyright (c) 2011 Massimo Di Pierro\n" \
+    "  All rights reserved\n" \
+    "  License: GPL 2.0\n\n" \
+    "  Written by Massimo Di Pierro <mdipierro@cs.depaul.edu>\n"
+
+description = "This program synthesizes random gauge configurations and\n" \
+    "propagators in every format that qcdutils_get.py can write and times\n" \
+    "read_header, full reads, full writes and every conversion in OPTIONS.\n" \
+    "Formats which cannot be written are built directly (header and raw\n" \
+    "data) so that they can be read and converted. Every case runs in a\n" \
+    "forked process. Results (MB/s, sites/s, peak RSS of the case) are\n" \
+    "saved as JSON to be compared across commits."
+
+GAUGES = (GaugeMDP,GaugeILDG,GaugeMILC,GaugeNERSC,GaugeSCIDAC)
+PROPAGATORS = (PropagatorMDP,PropagatorSCIDAC)
+POOL = 1024 # number of distinct random sites, repeated over the lattice
+
+class SilentProgress(object):
+    def __init__(self,*a,**b): pass
+    def start(self): return self
+    def update(self,value,slot=0): pass
+    def add(self,n,slot=0): pass
+    def finish(self): pass
+
+class RandomField(QCDFormat):
+    """
+    a source of random sites: SU(3) links for gauge fields, numbers in
+    [-1,1] for propagators. Sites are drawn from a pool of POOL random
+    sites so that generating the data does not dominate the timings.
+    """
+    def __init__(self,nt,nx,ny,nz,precision='f',is_gauge=True,seed=0):
+        rng = random.Random(seed)
+        self.precision = precision
+        self.size = (nt,nx,ny,nz)
+        self.is_gauge = is_gauge
+        if is_gauge:
+            hot = GaugeHot(1,POOL,1,1,seed = seed,precision = precision)
+            self.pool = [hot.read_data(0,k,0,0) for k in range(POOL)]
+        else:
+            self.pool = [[rng.uniform(-1,1) for i in range(16*9*2)]
+                         for k in range(POOL)]
+    def read_header(self):
+        (nt,nx,ny,nz) = self.size
+        return (self.precision,nt,nx,ny,nz)
+    def read_data(self,t,x,y,z):
+        (nt,nx,ny,nz) = self.size
+        return self.pool[(x+nx*(y+ny*(z+nz*t))) % POOL]
+    def close(self):
+        pass
+
+def megabytes(maxrss):
+    """ru_maxrss in MB"""
+    if sys.platform == 'darwin':
+        return maxrss/1e6 # bytes
+    return maxrss/1e3 # kilobytes
+
+def measure(f,nbytes,nsites,repeat=1):
+    """
+    times f in a forked process, so that peak_rss_mb is the peak resident
+    set size of that process only (which starts with the memory of the
+    benchmark at fork time), not of all the cases run so far
+    """
+    sys.stdout.flush()
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        try:
+            t0 = time.time()
+            for k in range(repeat):
+                f()
+            result = dict(seconds=(time.time()-t0)/repeat)
+        except Exception, e:
+            result = dict(error='%s: %s' % (e.__class__.__name__,e))
+        os.write(write_end,json.dumps(result))
+        sys.stdout.flush()
+        os._exit(0)
+    os.close(write_end)
+    data = ''.join(iter(lambda: os.read(read_end,4096),''))
+    os.close(read_end)
+    pid, status, usage = os.wait4(pid,0)
+    if not data:
+        return dict(error='process terminated with status %i' % status)
+    result = json.loads(data)
+    if 'error' in result:
+        return result
+    seconds = result['seconds']
+    return dict(seconds=seconds,
+                mb_per_second=nbytes/1e6/seconds if seconds else None,
+                sites_per_second=nsites/seconds if seconds else None,
+                peak_rss_mb=megabytes(usage.ru_maxrss))
+
+def attempt(results,key,f,*args):
+    """runs a benchmark and stores its result or its error under key"""
+    try:
+        results[key] = f(*args)
+    except Exception, e:
+        results[key] = dict(error='%s: %s' % (e.__class__.__name__,e))
+    print '%-60s %s' % (key,format_result(results[key]))
+
+def skip(results,key,reason):
+    """records a benchmark which cannot run"""
+    results[key] = dict(skipped=reason)
+    print '%-60s %s' % (key,format_result(results[key]))
+
+def format_result(result):
+    if 'skipped' in result:
+        return 'SKIPPED (%s)' % result['skipped']
+    if 'error' in result:
+        return 'FAILED (%s)' % result['error']
+    return '%8.3fs %9.2f MB/s %12.0f sites/s %8.1f MB' % \
+        (result['seconds'],result['mb_per_second'] or 0,
+         result['sites_per_second'] or 0,result['peak_rss_mb'])
+
+def payload(target,source):
+    """
+    the raw data of all the sites of source (a RandomField) in file order,
+    as packed by target, one timeslice at a time
+    """
+    (nt,nx,ny,nz) = source.size
+    sites = [target.pack(site) for site in source.pool]
+    n = nx*ny*nz
+    for t in xrange(nt):
+        yield ''.join(sites[(t*n+i) % POOL] for i in xrange(n))
+
+def build_milc(filename,source):
+    target = GaugeMILC(filename)
+    target.precision = source.precision
+    (nt,nx,ny,nz) = source.size
+    file = open(filename,'wb')
+    file.write(struct.pack(target.header_format,20103,nx,ny,nz,nt,'',0,0,0))
+    for data in payload(target,source):
+        file.write(data)
+    file.close()
+
+def build_nersc(filename,source):
+    target = GaugeNERSC(filename)
+    target.precision = source.precision
+    (nt,nx,ny,nz) = source.size
+    header = ['BEGIN_HEADER',
+              'DATATYPE = 4D_SU3_GAUGE_3x3',
+              'DIMENSION_1 = %i' % nx,
+              'DIMENSION_2 = %i' % ny,
+              'DIMENSION_3 = %i' % nz,
+              'DIMENSION_4 = %i' % nt,
+              'FLOATING_POINT = IEEE%iBIG' % (32 if source.precision=='f' else 64),
+              'CHECKSUM = 0',
+              'END_HEADER','']
+    file = open(filename,'wb')
+    file.write('\n'.join(header))
+    for data in payload(target,source):
+        file.write(data)
+    file.close()
+
+def build_scidac(filename,source):
+    target = (GaugeSCIDAC if source.is_gauge else PropagatorSCIDAC)(filename)
+    target.precision = source.precision
+    (nt,nx,ny,nz) = source.size
+    lime = Lime(filename,'wb')
+    lime.write('scidac-private-file-xml',
+               '<?xml version="1.0"?><scidacFile><version>1.1</version>'
+               '<spacetime>4</spacetime><dims>%i %i %i %i </dims>'
+               '<volfmt>0</volfmt></scidacFile>' % (nx,ny,nz,nt))
+    lime.write('scidac-private-record-xml',
+               '<?xml version="1.0"?><scidacRecord><version>1.1</version>'
+               '<precision>%s</precision></scidacRecord>' % source.precision.upper())
+    size = nt*nx*ny*nz*target.base_size*(4 if source.precision=='f' else 8)
+    lime.write('scidac-binary-data',payload(target,source),size)
+    lime.close()
+
+# formats without a working writer and how to build their files directly
+BUILDERS = {GaugeMILC:build_milc,GaugeNERSC:build_nersc,
+            GaugeSCIDAC:build_scidac,PropagatorSCIDAC:build_scidac}
+
+def read_all(formatter,filename):
+    source = formatter(filename)
+    (precision,nt,nx,ny,nz) = source.read_header()
+    for t in xrange(nt):
+        for z in xrange(nz):
+            for y in xrange(ny):
+                for x in xrange(nx):
+                    source.read_data(t,x,y,z)
+    source.close()
+
+def write_all(formatter,filename,source):
+    formatter(filename).convert_from(source)
+
+def convert(target,formatter,filename):
+    ofilename = filename+'.'+target
+    OPTIONS[target][0](ofilename).convert_from(formatter(filename))
+
+def bench_size(folder,size,precision,repeat):
+    (nt,nx,ny,nz) = size
+    nsites = nt*nx*ny*nz
+    label = '%ix%ix%ix%i' % size
+    results = {}
+    files = {}
+    sources = {True:RandomField(nt,nx,ny,nz,precision,True),
+               False:RandomField(nt,nx,ny,nz,precision,False)}
+    for formatter in GAUGES+PROPAGATORS:
+        is_gauge = formatter in GAUGES
+        filename = os.path.join(folder,'bench.%s.%s' % (label,formatter.__name__))
+        key = '%s/write/%s' % (label,formatter.__name__)
+        nbytes = nsites*(4 if is_gauge else 16)*9*2*(4 if precision=='f' else 8)
+        if not hasattr(formatter,'convert_from'):
+            skip(results,key,'no writer')
+        else:
+            attempt(results,key,measure,
+                    lambda: write_all(formatter,filename,sources[is_gauge]),
+                    nbytes,nsites)
+        if not 'skipped' in results[key] and not 'error' in results[key]:
+            files[formatter] = filename
+        elif formatter in BUILDERS:
+            # no working writer: the input file is built directly
+            key = '%s/build/%s' % (label,formatter.__name__)
+            attempt(results,key,measure,
+                    lambda: BUILDERS[formatter](filename,sources[is_gauge]),
+                    nbytes,nsites)
+            if not 'error' in results[key]:
+                files[formatter] = filename
+    filename = os.path.join(folder,'bench.%s.hot' % label)
+    attempt(results,'%s/generate/GaugeHot' % label,measure,
+            lambda: write_all(GaugeMDP,filename,
+                              GaugeHot(nt,nx,ny,nz,precision = precision)),
+            nsites*4*9*2*(4 if precision=='f' else 8),nsites)
+    os.unlink(filename)
+    for formatter in GAUGES+PROPAGATORS:
+        keys = ['%s/%s/%s' % (label,name,formatter.__name__) \
+                    for name in ('read_header','read')]
+        if not formatter in files:
+            for key in keys:
+                skip(results,key,'no input file')
+            continue
+        filename = files[formatter]
+        nbytes = os.path.getsize(filename)
+        attempt(results,keys[0],measure,
+                lambda: formatter(filename).read_header(),0,0,repeat)
+        attempt(results,keys[1],measure,
+                lambda: read_all(formatter,filename),nbytes,nsites)
+    for target in sorted(OPTIONS):
+        for formatter in OPTIONS[target][1:]:
+            key = '%s/convert/%s/%s' % (label,formatter.__name__,target)
+            if not hasattr(OPTIONS[target][0],'convert_from'):
+                skip(results,key,'no writer for %s' % target)
+                continue
+            if not formatter in files:
+                skip(results,key,'no input file')
+                continue
+            filename = files[formatter]
+            attempt(results,key,measure,lambda: convert(target,formatter,filename),
+                    os.path.getsize(filename),nsites)
+            for name in glob.glob(filename+'*.*'):
+                os.unlink(name)
+    return results
+
+def compare(results,filename):
+    """prints the speedup of results over the results stored in filename"""
+    old = json.load(open(filename,'r'))['results']
+    print '\ncomparison with %s (speedup > 1 means faster now)' % filename
+    for key in sorted(results):
+        a, b = old.get(key,{}), results[key]
+        if a.get('seconds') and b.get('seconds'):
+            print '%-60s %8.2fx' % (key,a['seconds']/b['seconds'])
+
+def shell_bench():
+    parser = OptionParser(usage,None,Option,version)
+    parser.description = description
+    parser.add_option('-s','--sizes',default='8x8x8x8,16x16x16x16,64x32x32x32',
+                      dest='sizes',help='comma separated lattice sizes TxXxYxZ')
+    parser.add_option('-p','--precision',default='f',dest='precision',
+                      help='f (single) or d (double)')
+    parser.add_option('-r','--repeat',default='10',dest='repeat',
+                      help='number of repetitions for read_header')
+    parser.add_option('-f','--folder',default=None,dest='folder',
+                      help='work folder (default is a temporary folder)')
+    parser.add_option('-o','--output',default='qcdutils_bench.json',dest='output',
+                      help='file where to save results as JSON')
+    parser.add_option('-c','--compare',default=None,dest='compare',
+                      help='JSON file of a previous run to compare with')
+    (options, args) = parser.parse_args()
+    qcdutils_get.Progress = SilentProgress
+    qcdutils_get.notify = lambda *a: None
+    folder = options.folder or tempfile.mkdtemp()
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+    results = {}
+    try:
+        for size in options.sizes.split(','):
+            size = tuple(int(x) for x in size.split('x'))
+            results.update(bench_size(folder,size,options.precision,
+                                      int(options.repeat)))
+    finally:
+        if not options.folder:
+            shutil.rmtree(folder)
+    revision = os.popen('git -C "%s" rev-parse HEAD 2>/dev/null' % \
+                            os.path.dirname(os.path.abspath(__file__))).read().strip()
+    report = dict(revision=revision or None,
+                  timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                  python=sys.version.split()[0],
+                  platform=platform.platform(),
+                  sizes=options.sizes,
+                  precision=options.precision,
+                  results=results)
+    json.dump(report,open(options.output,'w'),indent=2,sort_keys=True)
+    print 'results saved in %s' % options.output
+    if options.compare:
+        compare(results,options.compare)
+    return 0
+
+if __name__=='__main__': sys.exit(shell_bench())
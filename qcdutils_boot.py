@@ -3,9 +3,11 @@
 # create by: Massimo Di Pierro<mdipierro@cs.depaul.edu>
 # license: GPL2.0
 
-import sys, re, copy, random, glob, csv
+import os, sys, re, copy, random, glob, csv, multiprocessing, cPickle, json, struct, ast
+from array import array
 from optparse import *
 from math import *
+import numpy
 
 usage = "qcdutils_boot.py *.log 'x[<a>]/y[<b>]' 'abs(a-b)==1'\n" \
     "  scans all files *.log for expressions of the form\n" \
@@ -27,10 +29,159 @@ description = "This is program to scan the log files of a Markov Chain Monte Car
             
 class IBootstrapException(Exception): pass
 
+CHUNK_SIZE = 2**20 # bytes of log read at a time
+FLOAT_PATTERN = '[-+]?(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?'
+MAX_GROUPS = 99 # python regular expressions support at most 100 groups
+
+def combine_patterns(tag_patterns):
+    """
+    combines the patterns of all items into as few regular expressions as
+    possible, one alternative per item. The groups of item k are renamed
+    _ik_..., the whole alternative is group _ik so the item matched by an
+    occurrence is match.lastgroup, its name and value are in the groups
+    _ik__name__ and _ik__value__
+
+    >>> patterns=combine_patterns(['x\\[(?P<a>\\d+)\\]','y'])
+    >>> m=re.compile(patterns[0]).search('y = 2')
+    >>> print m.lastgroup, m.group('_i1___name__'), m.group('_i1___value__')
+    _i1 y 2
+    """
+    patterns, alternatives, ngroups = [], [], 0
+    for k,tag_pattern in enumerate(tag_patterns):
+        prefix='_i%i_' % k
+        tag_pattern=re.sub('\(\?P<(\w+)>','(?P<%s\\1>' % prefix,tag_pattern)
+        tag_pattern=re.sub('\(\?P=(\w+)\)','(?P=%s\\1)' % prefix,tag_pattern)
+        alternative='(?P<_i%i>(?P<%s__name__>%s)\s*(?:=|:|\s)?\s*(?P<%s__value__>%s))' % \
+            (k,prefix,tag_pattern,prefix,FLOAT_PATTERN)
+        groups=re.compile(alternative).groups
+        if alternatives and ngroups+groups>MAX_GROUPS:
+            patterns.append('|'.join(alternatives))
+            alternatives, ngroups = [], 0
+        alternatives.append(alternative)
+        ngroups+=groups
+    if alternatives: patterns.append('|'.join(alternatives))
+    return patterns
+
+def parse_file(args):
+    """
+    parses one log file in chunks of CHUNK_SIZE bytes with the combined
+    patterns, returns a dict {symbol: array('d') of values in file order}
+    and the offset where parsing stopped.
+    The last non blank line of a chunk, and what follows it, is carried
+    over to the next chunk since an occurrence may continue there.
+    args is (filename, patterns, offset=0, final=True): parsing starts at
+    offset and, unless final, a last line without newline is left for the
+    next time, since the file may still be growing.
+    """
+    filename, patterns = args[:2]
+    offset = args[2] if len(args)>2 else 0
+    final = args[3] if len(args)>3 else True
+    regexes=[re.compile(pattern) for pattern in patterns]
+    symbols={}
+    file=open(filename,'r')
+    file.seek(offset)
+    carry=''
+    while True:
+        chunk=file.read(CHUNK_SIZE)
+        buffer=carry+chunk
+        if chunk:
+            cut=len(buffer[:buffer.rfind('\n')+1].rstrip())
+            cut=buffer.rfind('\n',0,cut)+1
+        elif final:
+            cut=len(buffer)
+        else:
+            cut=buffer.rfind('\n')+1
+        start=cut
+        occurrences=[]
+        for regex in regexes:
+            for match in regex.finditer(buffer):
+                if match.end()>cut and (chunk or not final):
+                    start=min(start,match.start())
+                    break
+                occurrences.append(match)
+        if len(regexes)>1:
+            occurrences.sort(key=lambda match: match.start())
+        for match in occurrences:
+            if match.start()>=start: continue
+            prefix=match.lastgroup
+            name=match.group(prefix+'___name__')
+            value=float(match.group(prefix+'___value__'))
+            try: symbols[name].append(value)
+            except KeyError: symbols[name]=array('d',[value])
+        offset+=start
+        if not chunk: break
+        carry=buffer[start:]
+    file.close()
+    return symbols, offset
+
+COLUMNS_MAGIC = 'QCDCOLS1'
+
+def write_columns(filename,keys,data):
+    """
+    writes one row of float64 per key in a binary format which can be
+    memory mapped: 8 bytes of magic, the length of the header as 8 bytes
+    little endian, a JSON header {"keys":...,"shape":...,"dtype":"<f8"}
+    padded with spaces to a multiple of 8 bytes, then the rows
+
+    >>> write_columns('test_columns.bin',['a','b'],[[1,2,3],[4,5,6]])
+    >>> keys, data = read_columns('test_columns.bin')
+    >>> print keys, data[1].tolist()
+    [u'a', u'b'] [4.0, 5.0, 6.0]
+    """
+    data=numpy.asarray(data,dtype='<f8').reshape(len(keys),-1)
+    header=json.dumps(dict(keys=list(keys),shape=data.shape,dtype='<f8'))
+    header+=' '*(-len(header)%8)
+    file=open(filename,'wb')
+    file.write(COLUMNS_MAGIC+struct.pack('<Q',len(header))+header)
+    data.tofile(file)
+    file.close()
+
+def is_columns_file(filename):
+    return open(filename,'rb').read(len(COLUMNS_MAGIC))==COLUMNS_MAGIC
+
+def read_columns(filename):
+    """
+    reads a file written by write_columns, returns the keys and a read only
+    memory mapped (len(keys), columns) array
+    """
+    file=open(filename,'rb')
+    if file.read(len(COLUMNS_MAGIC))!=COLUMNS_MAGIC:
+        raise IOError, '%s is not a columns file' % filename
+    size=struct.unpack('<Q',file.read(8))[0]
+    header=json.loads(file.read(size))
+    file.close()
+    shape=tuple(header['shape'])
+    if not shape[0]*shape[1]:
+        return header['keys'], numpy.zeros(shape)
+    data=numpy.memmap(filename,dtype=header['dtype'],mode='r',
+                      offset=len(COLUMNS_MAGIC)+8+size,shape=shape)
+    return header['keys'], data
+
+SHARD_SIZE = 64 # bootstrap samples drawn with the same random generator
+SHARED = {} # state inherited by the bootstrap worker processes
+
+def bootstrap_shard(shard):
+    """
+    evaluates the expressions on one shard (start, n) of bootstrap samples,
+    drawn with a generator seeded with the seed and the shard index so
+    that samples do not depend on the number of processes
+    """
+    ibootstrap=SHARED['ibootstrap']
+    start, n = shard
+    if ibootstrap.seed is None:
+        rng=numpy.random.RandomState()
+    else:
+        rng=numpy.random.RandomState([ibootstrap.seed,start/SHARD_SIZE])
+    means=ibootstrap.resample(SHARED['data'],n,SHARED['mode'],SHARED['block_size'],rng)
+    return ibootstrap.evaluate(SHARED['codes'],means)
+
+
 class IBootstrap:
     def __init__(self,filepattern="*.log",expression="x[<a>]",condition="a%2==0",
                  min_index=0,max_index=0,nsamples=100,percent=0.158,
-		 output_prefix='qcdutils', raw=False,advanced=False,import_module=None,indices=None):
+		 output_prefix='qcdutils', raw=False,advanced=False,import_module=None,indices=None,
+                 mode='bootstrap',block_size=0,processes=1,state_file=None,
+                 storage='csv',window=0,alpha=0.0,seed=None):
         # indices is ignored by ibootstrap but has to be here 
         # becase of the design of iplotwx.py
         self.expression=re.sub('(\"|\<|\>)','',expression)
@@ -39,6 +190,10 @@ class IBootstrap:
 	self.report=[]
         self.import_module=import_module
         self.indices=indices
+        self.processes=processes
+        self.state_file=state_file
+        self.storage=storage
+        self.seed=seed
         try:
 	    self.parse_expression(expression,advanced)
             if not raw:
@@ -50,11 +205,18 @@ class IBootstrap:
                 self.reload_input(filepattern)
             self.find_expressions(expression,condition)
             if not max_index: max_index=self.length
-            self.trails(min_index,max_index)
-            self.bootstrap(min_index,max_index,nsamples,percent)          
+            self.trails(min_index,max_index,window,alpha)
+            self.bootstrap(min_index,max_index,nsamples,percent,mode,block_size)
             self.log_trails(output_prefix+'_trails.csv')
+            if window:
+                self.log_rows(output_prefix+'_window_trails.csv',self.window_trails,
+                              'moving average (window %i) trails' % window)
+            if alpha:
+                self.log_rows(output_prefix+'_ewma_trails.csv',self.ewma_trails,
+                              'exponentially weighted (alpha %g) trails' % alpha)
 	    self.log_samples(output_prefix+'_samples.csv')
             self.log_min_mean_max(output_prefix+'_results.csv')
+            self.log_covariances(output_prefix)
 	    self.status='success'      
     	except IBootstrapException:
             self.report.append('FATAL ERROR')        
@@ -81,23 +243,43 @@ class IBootstrap:
         else: c=d*int(c/d)
         return a,b,c
 
-    def make_regex(self,text):    
+    @staticmethod
+    def make_regex(text):    
 	for s in "\.%*+?()[]{}|": text=text.replace(s,'\\'+s)
 	text=re.sub('<(?P<id>\w+)>','(?P<\g<id>>[-|+]?\d+)',text)
 	return text
 
-    def parse_expression(self,expression,advanced):
-	items=re.compile('\"[^\"]+\"').findall(expression)
-        self.items=items
-        self.items_regex=[]
-        self.items_pattern=[]
-	for item in items:	
+    # caches shared by all instances: parsed items, namespaces and compiled
+    # expressions. The first two are filled before run_ensembles forks its
+    # processes (see fill_caches), so they are inherited by all of them
+    PARSED={}
+    NAMESPACES={}
+    CODES={}
+
+    @classmethod
+    def parsed(cls,expression,advanced):
+        """
+        returns, and caches, the items of expression with their regular
+        expressions and patterns (does not depend on the data)
+        """
+        if not (expression,advanced) in cls.PARSED:
+            items=re.compile('\"[^\"]+\"').findall(expression)
+            items_regex=[]
+            items_pattern=[]
+            for item in items:
                 if advanced: tag_pattern=item[1:-1]
-		else: tag_pattern=self.make_regex(item[1:-1])
-		float_pattern='[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?'
-		regex=re.compile('(?P<__name__>%s)\s*(=|:|\s)?\s*(?P<__value__>%s)' % (tag_pattern,float_pattern))
-                self.items_regex.append(regex)
-		self.items_pattern.append(tag_pattern)
+                else: tag_pattern=cls.make_regex(item[1:-1])
+                float_pattern='[-+]?(\d+(\.\d*)?|\.\d+)([eE][-+]?\d+)?'
+                regex=re.compile('(?P<__name__>%s)\s*(=|:|\s)?\s*(?P<__value__>%s)' % (tag_pattern,float_pattern))
+                items_regex.append(regex)
+                items_pattern.append(tag_pattern)
+            cls.PARSED[(expression,advanced)]=(items,items_regex,items_pattern,
+                                               combine_patterns(items_pattern))
+        return cls.PARSED[(expression,advanced)]
+
+    def parse_expression(self,expression,advanced):
+        (self.items,self.items_regex,self.items_pattern,self.items_patterns)=\
+            self.parsed(expression,advanced)
 
     def parse_input(self,filename):
         items=self.items
@@ -106,29 +288,67 @@ class IBootstrap:
             self.report.append("your expressions does not containes items in quotes")
             raise IBootstrapException
 	symbols={}
-	filenames=glob.glob(filename)
+	filenames=sorted(glob.glob(filename))
 	if len(filenames)>1: self.report.append('found %i files' % len(filenames))
 	elif len(filenames)==1: self.report.append('reading file %s' % filenames[0])
         else: 
             self.report.append('no input file matches the file pattern')
             raise IBootstrapException
-	for name in filenames:
-	    data=open(name,'r').read()
-	    for i in range(len(items)):	
-                item=items[i]
-                regex=items_regex[i]
-		groupindex=regex.groupindex
-		nameindex=0
-		valueindex=groupindex['__value__']-1
-		occurrences=regex.findall(data)
-		for occurrence in occurrences:
-		    try: value=float(occurrence[valueindex])
-		    except:
-		       self.report.append('error: non-float value at %s=%s' % occurrence)
-		       raise IBootstrapException
-		    try: symbols[occurrence[nameindex]].append(value)
-		    except: symbols[occurrence[nameindex]]=[value]        
+        files=self.load_state(filenames)
+        args=[]
+        for name in filenames:
+            stat=os.stat(name)
+            entry=files.get(name)
+            if entry and (entry['mtime'],entry['size'])==(stat.st_mtime,stat.st_size):
+                continue
+            if entry and stat.st_size<entry['offset']:
+                self.report.append('%s was truncated and will be parsed again' % name)
+                entry=files[name]=None
+            args.append((name,self.items_patterns,entry and entry['offset'] or 0,
+                         not self.state_file))
+            files[name]=dict(offset=entry and entry['offset'] or 0,
+                             mtime=stat.st_mtime,size=stat.st_size,
+                             symbols=entry and entry['symbols'] or {})
+        if args: self.report.append('parsing %i files' % len(args))
+        if self.processes>1 and len(args)>1:
+            pool=multiprocessing.Pool(self.processes)
+            results=pool.imap(parse_file,args)
+        else:
+            pool=None
+            results=(parse_file(arg) for arg in args)
+        try:
+            for arg,(file_symbols,offset) in zip(args,results):
+                entry=files[arg[0]]
+                entry['offset']=offset
+                entry['appended']=file_symbols
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+        # merges the files in order; prefix counts, for each symbol, the values
+        # which precede any new value and whose running sums are still valid
+        prefix={}
+        changed=self.state_removed
+        for name in filenames:
+            entry=files[name]
+            for key,values in entry['symbols'].items():
+                try: symbols[key].extend(values)
+                except KeyError: symbols[key]=array('d',values)
+                if not changed: prefix[key]=prefix.get(key,0)+len(values)
+            for key,values in entry.pop('appended',{}).items():
+                if not self.state_file: pass
+                elif key in entry['symbols']: entry['symbols'][key].extend(values)
+                else: entry['symbols'][key]=array('d',values)
+                try: symbols[key].extend(values)
+                except KeyError: symbols[key]=values
+                changed=True
 	self.symbols=symbols
+        cumulative={}
+        for key,values in symbols.items():
+            values=numpy.asarray(values,dtype=numpy.float64)
+            old=self.state_cumulative.get(key,numpy.zeros(0))[:prefix.get(key,0)]
+            cumulative[key]=numpy.concatenate((old,numpy.cumsum(values[len(old):])+(old[-1] if len(old) else 0.0)))
+        self.save_state(files,cumulative)
 
 	length=-1
         keys=symbols.keys()
@@ -140,157 +360,484 @@ class IBootstrap:
 	    if ell!=length:
 		self.report.append('warining, not all field with same occurrences')
 	    if ell<length: length=ell
-	for key in symbols.keys():     
-	    symbols[key]=symbols[key][:length]
+        self.make_arrays(symbols,length)
+        self.cumulative=numpy.array([cumulative[key][:length] for key in self.keys]).reshape(len(self.keys),length)
+
+    def load_state(self,filenames):
+        """
+        loads the per file offsets, mtimes, sizes and symbols from the state
+        file, if any and if it was made for the same items. Returns the
+        entries of the files in filenames.
+        """
+        self.state_cumulative={}
+        self.state_removed=False
+        if not self.state_file or not os.path.exists(self.state_file):
+            return {}
+        state=cPickle.load(open(self.state_file,'rb'))
+        if state.get('patterns')!=self.items_patterns:
+            self.report.append('state file %s is for other items, ignored' % self.state_file)
+            return {}
+        files=state['files']
+        for name in files.keys():
+            if not name in filenames:
+                self.report.append('%s no longer matches the file pattern' % name)
+                del files[name]
+                self.state_removed=True
+        self.state_cumulative=state['cumulative']
+        self.report.append('loaded state file %s' % self.state_file)
+        return files
+
+    def save_state(self,files,cumulative):
+        """saves the state file, atomically"""
+        if not self.state_file: return
+        state=dict(patterns=self.items_patterns,files=files,cumulative=cumulative)
+        cPickle.dump(state,open(self.state_file+'.tmp','wb'),cPickle.HIGHEST_PROTOCOL)
+        os.rename(self.state_file+'.tmp',self.state_file)
+        self.report.append('state saved in %s' % self.state_file)
+
+    def make_arrays(self,symbols,length):
+        """
+        stores all symbols as rows of one (nsymbols, length) array self.data,
+        in the order of self.keys; self.symbols[key] is a view of its row
+        """
+        self.keys=sorted(symbols.keys())
+        self.data=numpy.empty((len(self.keys),length))
+        for i,key in enumerate(self.keys):
+            self.data[i]=numpy.asarray(symbols[key],dtype=numpy.float64)[:length]
+        self.symbols=dict((key,self.data[i]) for i,key in enumerate(self.keys))
         self.length=length
 
+    def compile_condition(self,condition):
+        """
+        splits the condition into the terms of its top level "and" and
+        compiles each of them, returns a list of (names used, code)
+        """
+        try:
+            tree=ast.parse(condition.strip(),mode='eval').body
+        except SyntaxError:
+            self.report.append('condition "%s" is not valid' % condition)
+            raise IBootstrapException
+        if isinstance(tree,ast.BoolOp) and isinstance(tree.op,ast.And):
+            terms=tree.values
+        else:
+            terms=[tree]
+        conditions=[]
+        for term in terms:
+            names=set(node.id for node in ast.walk(term) if isinstance(node,ast.Name))
+            code=compile(ast.fix_missing_locations(ast.Expression(body=term)),
+                         condition,'eval')
+            conditions.append((names,code))
+        return conditions
+
     def find_expressions(self,expression,condition):
+        """
+        finds all the expressions obtained replacing each quoted item with a
+        matching symbol such that variables shared by items take the same
+        values and the condition is true. Combinations are built item by
+        item, joining on the shared variables, and each term of the
+        condition filters them as soon as its variables are known.
+        """
 	items=self.items
         symbols=self.symbols
-	items_pattern=self.items_pattern
-	columns=[]
-	items_regex=[]
-	for tag_pattern in items_pattern:
-	    keys=[]
-	    regex=re.compile(tag_pattern)
-	    items_regex.append(regex)
-	    for key in symbols.keys():
-		m=regex.match(key)
-		if m: keys.append(m)
-	    if not keys:
-	        self.report.append('unable to match entire expression')
-	        raise IBootstrapException
-	    columns.append(keys)
-	
+        self.make_namespace()
+        namespace=self.scalar_namespace
+        columns=[]
+        for tag_pattern in self.items_pattern:
+            regex=re.compile(tag_pattern)
+            matches=[]
+            for key in symbols.keys():
+                m=regex.match(key)
+                if m:
+                    matches.append((m.group(0),dict((name,float(m.group(name))) \
+                                       for name in regex.groupindex)))
+            if not matches:
+                self.report.append('unable to match entire expression')
+                raise IBootstrapException
+            columns.append((sorted(regex.groupindex),matches))
+        conditions=self.compile_condition(condition)
+        all_names=set(name for names,matches in columns for name in names)
+        def check(terms,loc):
+            for code in terms:
+                try:
+                    if eval(code,namespace,loc)==False: return False
+                except Exception:
+                    self.report.append('expression "%s" contains undefined variables' % condition)
+                    raise IBootstrapException
+            return True
+        # combinations as (list of matched symbols, variables)
+        combinations=[([],{})]
+        bound=set()
+        pending=conditions
+        for names,matches in columns:
+            shared=[name for name in names if name in bound]
+            index={}
+            for m in matches:
+                index.setdefault(tuple(m[1][name] for name in shared),[]).append(m)
+            bound.update(names)
+            terms=[code for used,code in pending if not (used & all_names)-bound]
+            pending=[(used,code) for used,code in pending if (used & all_names)-bound]
+            joined=[]
+            for keys,loc in combinations:
+                for key,variables in index.get(tuple(loc[name] for name in shared),[]):
+                    variables=dict(loc,**variables)
+                    if check(terms,variables):
+                        joined.append((keys+[key],variables))
+            combinations=joined
 	expressions=[]
         variables={}
-	counters=[0]*len(items)
-	if 0 in counters:
-	     # DO SOMETHING
-	     pass        
-	done=False
-	while 1:
-	    e=copy.copy(expression)
-	    isvalid=True
-	    loc={}
-	    for i in range(len(items)):
-		m=columns[i][counters[i]]            
-		e=e.replace(items[i],m.group(0),1)            
-		for key in items_regex[i].groupindex.keys():
-		    value=items_regex[i].groupindex[key]
-		    v=float(m.group(value))
-		    if loc.has_key(key) and loc[key]!=v: isvalid=False
-		    else: loc[key]=v
-	    variables[e]=copy.copy(loc)
-	    exec('from math import *') in loc
-            if self.import_module:
-                exec('from %s import *' % self.import_module) in loc	    
-            if not self.restricted_eval(condition,loc): isvalid=False
-	    if loc['__result__']==False: isvalid=False
-	    if isvalid:
-		expressions.append(e)
-            else:
-                del variables[e]
-
-	    counters[0]+=1
-	    for i in range(len(counters)):
-		if counters[i]>=len(columns[i]):
-		    counters[i]=0
-		    if i<len(counters)-1:
-			counters[i+1]+=1
-		    else:
-			done=True
-	    if done: break
+        for keys,loc in combinations:
+            e=expression
+            for item,key in zip(items,keys):
+                e=e.replace(item,key,1)
+            expressions.append(e)
+            variables[e]=loc
 	self.expressions=expressions
         self.variables=variables
 
     def compute_autocorrelations(self):
-	### perhps this should compute Hurst exponent too
-	symbols=self.symbols
-	self.autocorrelations={}
-	for key,sq in symbols.items():
-	    ac=self.autocorrelations[key]=[]
-	    n=len(sq)
-	    mu=sum(sq)/n
-	    sd2=sum([(k-mu)**2 for k in sq])/n	    
-	    for i in range(0,n/2):
-		auto=0.0
-		for j in range(i,n):
-		    auto+=(sq[j-i]-mu)*(sq[j]-mu)
-		if sd2>0: ac.append(auto/(n-i)/sd2)
-                else: ac.append(1.0)
-            if len(ac)<2:
-                 print "not enough data points" 
+        """
+        computes the normalized autocorrelations of all symbols at once via
+        FFT, for lags 0...n/2-1, and the integrated autocorrelation times
+        """
+        ### perhps this should compute Hurst exponent too
+        self.autocorrelations={}
+        self.tau_int={}
+        n=self.length
+        if n<4:
+            print "not enough data points"
+            return
+        centered=self.data-self.data.mean(1).reshape(-1,1)
+        size=1
+        while size<2*n: size*=2
+        f=numpy.fft.rfft(centered,size)
+        gamma=numpy.fft.irfft(f*f.conjugate(),size)[:,:n/2]
+        gamma/=numpy.arange(n,n-n/2,-1)
+        for k,key in enumerate(self.keys):
+            if gamma[k,0]>0:
+                ac=gamma[k]/gamma[k,0]
             else:
-                self.report.append("autocorrelation for %s and d=1 is %g" % (key,ac[1]))
+                ac=numpy.ones(n/2)
+            self.autocorrelations[key]=ac.tolist()
+            tau,dtau,window=self.integrated_autocorrelation_time(ac,n)
+            self.tau_int[key]=(tau,dtau,window,n/(2.0*tau))
+            self.report.append("autocorrelation for %s and d=1 is %g" % (key,ac[1]))
+            self.report.append("tau_int for %s is %g +/- %g (window %i, n_eff %g)" % \
+                                   (key,tau,dtau,window,n/(2.0*tau)))
 
+    @staticmethod
+    def integrated_autocorrelation_time(rho,n,S=1.5):
+        """
+        integrated autocorrelation time of normalized autocorrelations rho
+        with the automatic window of Wolff (hep-lat/0306017). Returns
+        (tau_int, error on tau_int (Madras-Sokal), window)
 
-    def trails(self,min_index,max_index):
-	""" under development """ 
-        expressions=self.expressions
-	symbols=self.symbols
-        loc={}
-        exec('from math import *') in loc
-        if self.import_module: exec('from %s import *' % self.import_module) in loc	    
-	trails={}
-	avgs={}
-        n=max_index-min_index        
-	for key in symbols.keys():     
-            sq=symbols[key]
-            aq=avgs[key]=[sq[min_index]]
-            for i in range(1,n):
-                aq.append((i*aq[i-1]+sq[min_index+i])/(i+1))
-	for expression in expressions:
-	    trails[expression]=[0]*n
-            for i in range(n):
-                result=expression	    
-    	        for key in avgs.keys():
-		    result=result.replace(key,str(avgs[key][i]))                                        
-		trails[expression][i]=self.restricted_eval(result,loc)
-	self.trails=trails        
-
-    def average(self,expressions,symbols,min_index,max_index):
-	results={}
-	avgs={}
-	loc={}
-        exec('from math import *') in loc
-        if self.import_module: exec('from %s import *' % self.import_module) in loc	    
-	for key in symbols.keys():        
-	    avgs[key]=sum(symbols[key][min_index:max_index])/(max_index-min_index)
-	for expression in expressions:
-	    result=expression
-	    for key in avgs.keys():
-		result=result.replace(key,str(avgs[key]))                        
-	    results[expression]=self.restricted_eval(result,loc)
-	return results
-
-    def bootstrap(self,min_index,max_index,nsamples=100,percent=0.158):
+        >>> rho=[0.5**t for t in range(100)]
+        >>> tau,dtau,window=IBootstrap.integrated_autocorrelation_time(rho,10000)
+        >>> print round(tau,2)
+        1.5
+        """
+        tau=0.5
+        window=len(rho)-1
+        for W in range(1,len(rho)):
+            tau+=rho[W]
+            if tau<=0.5:
+                window=W
+                break
+            tauW=S/log((2*tau+1)/(2*tau-1))
+            if exp(-W/tauW)-tauW/sqrt(W*n)<0:
+                window=W
+                break
+        tau=max(tau,0.5)
+        return tau,tau*sqrt((4.0*window+2)/n),window
+
+    def trails(self,min_index,max_index,window=0,alpha=0.0):
+        """
+        computes, for every expression, its value on the running averages of
+        the symbols from min_index (self.trails), and optionally on their
+        averages over the last window steps (self.window_trails) and on
+        their exponentially weighted averages (self.ewma_trails).
+        Averages are computed for all symbols at once from cumulative sums
+        and each expression is evaluated once over all steps.
+        """
+        codes=self.compile_expressions(self.expressions)
+        n=max_index-min_index
+        cumulative=getattr(self,'cumulative',None)
+        if cumulative is None:
+            cumulative=numpy.cumsum(self.data,1)
+        sums=cumulative[:,min_index:max_index].copy()
+        if min_index>0:
+            sums-=cumulative[:,min_index-1:min_index]
+        steps=numpy.arange(1,n+1)
+        def evaluate(avgs):
+            return dict((expression,values.tolist()) for expression,values \
+                            in zip(self.expressions,self.evaluate(codes,avgs)))
+        self.trails=evaluate(sums/steps)
+        if window:
+            avgs=sums.copy()
+            avgs[:,window:]-=sums[:,:-window]
+            self.window_trails=evaluate(avgs/numpy.minimum(steps,window))
+        if alpha:
+            self.ewma_trails=evaluate(self.ewma(self.data[:,min_index:max_index],alpha))
+
+    @staticmethod
+    def ewma(data,alpha):
+        """
+        exponentially weighted moving averages of the rows of data,
+        y[i]=(1-alpha)*y[i-1]+alpha*x[i] with y[0]=x[0], computed in blocks
+        short enough for the weights (1-alpha)**-k not to overflow
+
+        >>> print IBootstrap.ewma(numpy.array([[1.0,2.0,2.0]]),0.5).tolist()
+        [[1.0, 1.5, 1.75]]
+        """
+        if alpha>=1: return data.copy()
+        y=numpy.empty(data.shape)
+        if not data.shape[1]: return y
+        size=max(1,int(18.0/-log(1.0-alpha)))
+        previous=data[:,0].copy()
+        for start in range(0,data.shape[1],size):
+            x=data[:,start:start+size]
+            weights=(1.0-alpha)**numpy.arange(x.shape[1])
+            block=weights*(alpha*numpy.cumsum(x/weights,1)+(1.0-alpha)*previous.reshape(-1,1))
+            y[:,start:start+size]=block
+            previous=block[:,-1]
+        return y
+
+    # math functions replaced by numpy ufuncs with the same meaning
+    UFUNCS=dict(acos='arccos',asin='arcsin',atan='arctan',atan2='arctan2',
+                acosh='arccosh',asinh='arcsinh',atanh='arctanh',pow='power',
+                sqrt='sqrt',exp='exp',log='log',log10='log10',sin='sin',
+                cos='cos',tan='tan',sinh='sinh',cosh='cosh',tanh='tanh',
+                fabs='fabs',floor='floor',ceil='ceil',hypot='hypot')
+
+    @classmethod
+    def namespaces(cls,import_module):
+        """
+        returns, and caches, the namespaces where expressions are evaluated:
+        math (as numpy ufuncs) plus the optional import_module, and the
+        same with the scalar math functions
+        """
+        if not import_module in cls.NAMESPACES:
+            namespace={}
+            exec('from math import *') in namespace
+            for name,ufunc in cls.UFUNCS.items():
+                namespace[name]=getattr(numpy,ufunc)
+            if import_module:
+                exec('from %s import *' % import_module) in namespace
+            scalar_namespace=dict(namespace)
+            exec('from math import *') in scalar_namespace
+            if import_module:
+                exec('from %s import *' % import_module) in scalar_namespace
+            cls.NAMESPACES[import_module]=(namespace,scalar_namespace)
+        return cls.NAMESPACES[import_module]
+
+    def make_namespace(self):
+        """sets and returns the namespace where expressions are evaluated"""
+        if not hasattr(self,'namespace'):
+            self.namespace,self.scalar_namespace=self.namespaces(self.import_module)
+        return self.namespace
+
+    def compile_expressions(self,expressions):
+        """
+        compiles each expression once into a code object where every symbol
+        is replaced by __x[i], i being the index of the symbol in self.keys
+        """
+        self.make_namespace()
+        keys=tuple(self.keys)
+        cache=self.CODES.setdefault(keys,{})
+        missing=[expression for expression in expressions if not expression in cache]
+        if missing:
+            index=dict((key,i) for i,key in enumerate(keys))
+            regex=re.compile('|'.join(re.escape(key) for key in \
+                                          sorted(keys,key=len,reverse=True)))
+            for expression in missing:
+                source=regex.sub(lambda m: '__x[%i]' % index[m.group(0)],expression)
+                try:
+                    cache[expression]=compile(source,expression,'eval')
+                except SyntaxError:
+                    self.report.append('expression "%s" is not valid' % expression)
+                    raise IBootstrapException
+        return [(expression,cache[expression]) for expression in expressions]
+
+    def evaluate(self,codes,means):
+        """
+        evaluates the compiled expressions on means, a (nsymbols, n) array
+        (for example n bootstrap samples or n trail steps), all n at once.
+        returns a (nexpressions, n) array. Falls back to one evaluation per
+        column if an expression does not accept arrays or, since numpy
+        errors are raised here, has a domain error (then math fails too).
+        """
+        n=means.shape[1]
+        results=numpy.empty((len(codes),n))
+        for k,(expression,code) in enumerate(codes):
+            try:
+                with numpy.errstate(divide='raise',over='raise',invalid='raise'):
+                    results[k]=eval(code,self.namespace,{'__x':means})
+            except Exception:
+                columns=means.T.tolist()
+                try:
+                    for j in range(n):
+                        results[k,j]=eval(code,self.scalar_namespace,
+                                          {'__x':columns[j]})
+                except Exception:
+                    self.report.append('expression "%s" contains undefined variables' % expression)
+                    raise IBootstrapException
+        return results
+
+    def average(self,expressions,means):
+        """
+        evaluates expressions given the means of the symbols (in the order
+        of self.keys), returns a dict {expression:value}
+        """
+        codes=self.compile_expressions(expressions)
+        values=self.evaluate(codes,means.reshape(len(self.keys),1))[:,0]
+        return dict(zip(expressions,values.tolist()))
+
+    MODES=('bootstrap','block','moving_block','jackknife','block_jackknife')
+
+    def weights(self,length,nsamples,mode='bootstrap',block_size=1,rng=numpy.random):
+        """
+        returns a (nsamples, length) matrix: how many times each measurement
+        enters each sample, according to the resampling mode:
+        - bootstrap: measurements drawn with replacement
+        - block: non-overlapping blocks of block_size drawn with replacement
+        - moving_block: blocks starting anywhere drawn with replacement
+        In block modes the last length % block_size measurements are dropped.
+        Jackknife modes need no weights, see resample.
+        Random numbers are drawn from rng, a numpy.random.RandomState.
+        """
+        nblocks=length/block_size
+        if mode=='bootstrap':
+            indices=rng.randint(0,length,(nsamples,length))
+            indices+=numpy.arange(nsamples)[:,None]*length
+            counts=numpy.bincount(indices.ravel(),minlength=nsamples*length)
+            return counts.reshape(nsamples,length).astype(numpy.float64)
+        counts=numpy.zeros((nsamples,length))
+        if mode=='block':
+            indices=rng.randint(0,nblocks,(nsamples,nblocks))
+            indices+=numpy.arange(nsamples)[:,None]*nblocks
+            blocks=numpy.bincount(indices.ravel(),minlength=nsamples*nblocks)
+            blocks=blocks.reshape(nsamples,nblocks)
+        elif mode=='moving_block':
+            nstarts=length-block_size+1
+            indices=rng.randint(0,nstarts,(nsamples,nblocks))
+            indices+=numpy.arange(nsamples)[:,None]*nstarts
+            starts=numpy.bincount(indices.ravel(),minlength=nsamples*nstarts)
+            starts=starts.reshape(nsamples,nstarts)
+            # measurement j is covered by the blocks starting in [j-block_size+1,j]
+            cumulative=numpy.zeros((nsamples,length+1))
+            cumulative[:,1:nstarts+1]=numpy.cumsum(starts,1)
+            cumulative[:,nstarts+1:]=cumulative[:,nstarts:nstarts+1]
+            j=numpy.arange(length)
+            counts[:]=cumulative[:,j+1]-cumulative[:,numpy.maximum(j+1-block_size,0)]
+            return counts
+        else:
+            raise IBootstrapException
+        counts[:,:nblocks*block_size]=numpy.repeat(blocks,block_size,1)
+        return counts
+
+    def resample(self,data,nsamples,mode='bootstrap',block_size=1,rng=numpy.random):
+        """
+        returns a (nsymbols, nsamples) array with the means of the symbols
+        for nsamples resamplings of the columns of data (see weights).
+        The resamplings are a (nsamples, length) matrix of counts, so all
+        the resampled means are one product data x counts^T instead of a
+        (nsymbols, nsamples, length) gather. Jackknife means leave out one
+        measurement (or one block of block_size, dropping the last
+        length % block_size measurements) and come from the sums directly,
+        with one sample per measurement (or block) whatever nsamples.
+        """
+        if mode=='jackknife':
+            length=data.shape[1]
+            return (data.sum(1).reshape(-1,1)-data)/(length-1)
+        elif mode=='block_jackknife':
+            nblocks=data.shape[1]/block_size
+            blocks=data[:,:nblocks*block_size].reshape(data.shape[0],nblocks,block_size).sum(2)
+            total=blocks.sum(1).reshape(-1,1)
+            return (total-blocks)/(nblocks*block_size-block_size)
+        counts=self.weights(data.shape[1],nsamples,mode,block_size,rng)
+        return numpy.dot(data,counts.T)/counts.sum(1)
+
+    def auto_block_size(self):
+        """
+        block size from the largest integrated autocorrelation time,
+        ceil(2 tau_int), computing the autocorrelations if needed
+        """
+        if not getattr(self,'tau_int',None):
+            self.compute_autocorrelations()
+        if not getattr(self,'tau_int',None):
+            return 1
+        return int(ceil(2*max(v[0] for v in self.tau_int.values())))
+
+    def resampled_values(self,data,codes,nsamples,mode='bootstrap',block_size=1):
+        """
+        returns the (nexpressions, nsamples) values of the compiled
+        expressions on the resamplings of data. Bootstrap samples are drawn
+        in shards of SHARD_SIZE (see bootstrap_shard), in parallel when
+        self.processes>1; the result is the same for any number of processes.
+        """
+        if mode in ('jackknife','block_jackknife'):
+            return self.evaluate(codes,self.resample(data,nsamples,mode,block_size))
+        shards=[(start,min(SHARD_SIZE,nsamples-start)) \
+                    for start in range(0,nsamples,SHARD_SIZE)]
+        SHARED.update(ibootstrap=self,data=data,codes=codes,mode=mode,
+                      block_size=block_size)
+        try:
+            if self.processes>1 and len(shards)>1:
+                pool=multiprocessing.Pool(self.processes)
+                try:
+                    blocks=pool.map(bootstrap_shard,shards)
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                blocks=map(bootstrap_shard,shards)
+        finally:
+            SHARED.clear()
+        return numpy.hstack(blocks)
+
+    def bootstrap(self,min_index,max_index,nsamples=100,percent=0.158,
+                  mode='bootstrap',block_size=0):
         expressions=self.expressions
-        symbols=self.symbols
         if max_index>self.length: max_index=self.length
         if min_index>max_index: min_index,max_index=max_index,min_index
         if min_index<0: min_index=0 
-        length=max_index-min_index
-	samples={}
-	means=results=self.average(expressions,symbols,min_index,max_index)
-	for key in results.keys(): samples[key]=[]
-	for sample in range(nsamples):
-	    v=[random.randint(min_index,max_index-1) for i in range(length)]       
-	    symbols2={}        
-	    for key in symbols.keys():
-		s=symbols[key]
-		s2=symbols2[key]=[]            
-		for i in v:
-		    s2.append(s[i])                
-	    results=self.average(expressions,symbols2,min_index,max_index)
-	    for key in results.keys():
-		 samples[key].append(results[key])
+        if not mode in self.MODES:
+            self.report.append('unknown resampling mode "%s"' % mode)
+            raise IBootstrapException
+        data=self.data[:,min_index:max_index]
+        length=data.shape[1]
+        if mode!='bootstrap' and length<2:
+            self.report.append('resampling mode %s needs at least 2 measurements, found %i' % (mode,length))
+            raise IBootstrapException
+        if mode in ('block','moving_block','block_jackknife'):
+            if not block_size:
+                block_size=self.auto_block_size()
+            if block_size>length/2:
+                # at least two blocks, else every resampling is the mean
+                self.report.append('block size %i reduced to %i (at least 2 blocks)' % (block_size,length/2))
+                block_size=length/2
+            block_size=max(1,block_size)
+            self.report.append('resampling mode: %s, block size: %i' % (mode,block_size))
+        else:
+            block_size=1
+            self.report.append('resampling mode: %s' % mode)
+        means=self.average(expressions,data.mean(1))
+        codes=self.compile_expressions(expressions)
+        values=self.resampled_values(data,codes,nsamples,mode,block_size)
+        nsamples=values.shape[1]
+        if mode in ('jackknife','block_jackknife'):
+            # rescaled so that the spread of the samples is the jackknife error
+            center=values.mean(1).reshape(-1,1)
+            values=center+sqrt(nsamples-1)*(values-center)
+        self.covariances(expressions,values,mode in ('jackknife','block_jackknife'))
+        # samples keep their order, so that column j is the j-th resampling
+        samples=dict(zip(expressions,values.tolist()))
+        sorted_samples=dict(zip(expressions,numpy.sort(values,1).tolist()))
         min_mean_max={}
-	for key in results.keys():
-            samples[key].sort()      
-            s=samples[key]
-	    min_mean_max[key]=self.super_round(s[int(percent*nsamples)],means[key],s[int((1.0-percent)*nsamples)])
-	keys=min_mean_max.keys()
+        for key in means.keys():
+            s=sorted_samples[key]
+            min_mean_max[key]=self.super_round(s[int(percent*nsamples)],means[key],s[int((1.0-percent)*nsamples)])
+        keys=min_mean_max.keys()
         keys.sort()
         for key in keys:
             m=min_mean_max[key]
@@ -298,21 +845,63 @@ class IBootstrap:
         self.samples=samples
         self.min_mean_max=min_mean_max
 
+    def covariances(self,expressions,values,jackknife=False):
+        """
+        computes the covariance and correlation matrices of the expressions
+        (in sorted order, self.covariance_keys) from their (nexpressions,
+        nsamples) resampled values, as one matrix product
+        """
+        order=sorted(range(len(expressions)),key=lambda i: expressions[i])
+        deviations=values[order]-values[order].mean(1).reshape(-1,1)
+        nsamples=values.shape[1]
+        norm=nsamples if jackknife else max(nsamples-1,1)
+        covariance=numpy.dot(deviations,deviations.T)/norm
+        sd=numpy.sqrt(covariance.diagonal())
+        sd[sd==0]=1.0
+        self.covariance_keys=[expressions[i] for i in order]
+        self.covariance=covariance
+        self.correlation=covariance/numpy.outer(sd,sd)
+
+    def log_covariances(self,prefix='qcdutils'):
+        """saves covariance and correlation matrices as binary columns"""
+        for name,matrix in (('covariance',self.covariance),('correlation',self.correlation)):
+            filename='%s_%s.bin' % (prefix,name)
+            write_columns(filename,self.covariance_keys,matrix)
+            self.report.append('%s matrix saved in %s' % (name,filename))
+
+    def log_rows(self,filename,rows,what):
+        """
+        saves rows {key:values} as csv (one row per key), as binary columns
+        (filename with .bin instead of .csv, see write_columns) or both,
+        according to self.storage
+        """
+        keys=sorted(rows.keys())
+        if self.storage in ('csv','both'):
+            writer=csv.writer(open(filename,'w'),delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
+            for key in keys: writer.writerow([key]+list(rows[key]))
+            self.report.append('%s saved in %s' % (what,filename))
+        if self.storage in ('bin','both'):
+            filename=re.sub('\.csv$','',filename)+'.bin'
+            write_columns(filename,keys,[rows[key] for key in keys])
+            self.report.append('%s saved in %s' % (what,filename))
+
     def log_raw_data(self,filename='qcdutils_raw_data.csv'):
-        writer=csv.writer(open(filename,'w'),delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
-        keys=self.symbols.keys()
-        keys.sort()
-        for key in keys: writer.writerow([key]+self.symbols[key])
-        self.report.append('raw data saved in %s' % filename)
+        self.log_rows(filename,self.symbols,'raw data')
 
     def log_autocorrelations(self,filename='qcdutils_autocorrelations.csv'):
         writer=csv.writer(open(filename,'w'),delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
         keys=self.autocorrelations.keys()
         keys.sort()
-        for key in keys: writer.writerow([key]+self.autocorrelations[key])
+        writer.writerow(['[symbol]','[tau_int]','[dtau_int]','[window]','[n_eff]'])
+        for key in keys:
+            writer.writerow([key]+list(self.tau_int[key])+self.autocorrelations[key])
         self.report.append('autocorrelations saved in %s' % filename)
 
     def reload_input(self,filename):
+        if is_columns_file(filename):
+            keys, data = read_columns(filename)
+            self.make_arrays(dict(zip(keys,data)),data.shape[1])
+            return
         reader=csv.reader(open(filename,'r'),delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
         symbols={}
         length=-1
@@ -321,22 +910,13 @@ class IBootstrap:
             ell=len(data)
             if length==-1: length=ell
             elif ell<length: length=ell
-        self.symbols=symbols
-        self.length=length
+        self.make_arrays(symbols,length)
 
     def log_samples(self,filename='qcdutils_samples.csv'):
-        writer=csv.writer(open(filename,'w'),delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
-        keys=self.samples.keys()
-        keys.sort()
-        for key in keys: writer.writerow([key]+self.samples[key])
-        self.report.append('bootstrap samples saved in %s' % filename)
+        self.log_rows(filename,self.samples,'bootstrap samples')
 
     def log_trails(self,filename='qcdutils_trails.csv'):
-        writer=csv.writer(open(filename,'w'),delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
-        keys=self.trails.keys()
-        keys.sort()
-        for key in keys: writer.writerow([key]+self.trails[key])
-        self.report.append('average trails saved in %s' % filename)
+        self.log_rows(filename,self.trails,'average trails')
     
     def log_min_mean_max(self,filename='qcdutils_results.csv'): 
         writer=csv.writer(open(filename,'w'),delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
@@ -358,6 +938,84 @@ class IBootstrap:
         for msg in self.report:
             file.write('%s\n' % msg)
 
+def read_manifest(filename):
+    """
+    reads an ensemble manifest: a csv file with a header where the first
+    column is the file pattern of the logs of an ensemble and the others
+    are its parameters (for example beta,mass,L). Returns the parameter
+    names and a list of (file pattern, parameter values)
+    """
+    rows=[row for row in csv.reader(open(filename,'r')) if row]
+    def convert(value):
+        try: return float(value)
+        except ValueError: return value.strip()
+    names=[name.strip() for name in rows[0][1:]]
+    return names, [(row[0].strip(),[convert(x) for x in row[1:]]) for row in rows[1:]]
+
+def fill_caches(expression,advanced=False,import_module=None):
+    """
+    fills the caches of IBootstrap which do not depend on the data (parsed
+    items and namespaces), for example before forking processes which
+    then inherit them. Compiled expressions depend on the symbols found in
+    the logs and are cached by each process.
+    """
+    IBootstrap.parsed(expression,advanced)
+    IBootstrap.namespaces(import_module)
+
+def ensemble_job(job):
+    """runs IBootstrap for one ensemble, returns its status, report and rows"""
+    filepattern, args, options = job
+    ibootstrap=IBootstrap(filepattern,*args,**options)
+    variables, rows = [], []
+    if ibootstrap.status=='success' and ibootstrap.min_mean_max:
+        keys=sorted(ibootstrap.min_mean_max)
+        variables=sorted(ibootstrap.variables[keys[0]])
+        rows=[[key]+[ibootstrap.variables[key][var] for var in variables]+\
+                  list(ibootstrap.min_mean_max[key]) for key in keys]
+    return ibootstrap.status, ibootstrap.report, ibootstrap.expression, variables, rows
+
+def run_ensembles(manifest,expression,condition='True',processes=1,
+                  output_prefix='qcdutils',**options):
+    """
+    runs the same analysis for every ensemble in the manifest (see
+    read_manifest), in a pool of processes which inherit the parsed patterns
+    and the namespace (see fill_caches) and reuse compiled expressions
+    across the ensembles they run. Each ensemble saves
+    its files with prefix output_prefix+'_ensemble<i>'; all results go in
+    one table output_prefix+'_ensembles.csv' with columns
+    [expression], parameters, variables, [min], [mean], [max]
+    which qcdutils_fit.py can read. Returns a list of (file pattern,
+    status, report), one per ensemble.
+    """
+    names, ensembles = read_manifest(manifest)
+    state_file=options.pop('state_file',None)
+    jobs=[]
+    for i,(filepattern,parameters) in enumerate(ensembles):
+        job_options=dict(options,output_prefix='%s_ensemble%i' % (output_prefix,i))
+        job_options['processes']=1 if processes>1 else options.get('processes',1)
+        if state_file: job_options['state_file']='%s.%i' % (state_file,i)
+        jobs.append((filepattern,(expression,condition),job_options))
+    fill_caches(expression,options.get('advanced',False),options.get('import_module'))
+    if processes>1 and len(jobs)>1:
+        pool=multiprocessing.Pool(processes)
+        try:
+            results=pool.map(ensemble_job,jobs)
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        results=map(ensemble_job,jobs)
+    header, rows = None, []
+    for (filepattern,parameters),(status,report,label,variables,table) in zip(ensembles,results):
+        if table and not header:
+            header=[label]+names+variables+['[min]','[mean]','[max]']
+        for row in table:
+            rows.append(row[:1]+parameters+row[1:])
+    filename=output_prefix+'_ensembles.csv'
+    writer=csv.writer(open(filename,'w'),delimiter=',',quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerows(([header] if header else [])+rows)
+    return [(filepattern,status,report) for (filepattern,parameters),(status,report,label,variables,table) \
+                in zip(ensembles,results)]
 
 def test_ibootstrap():
     file=open('test_samples.log','w')
@@ -369,6 +1027,34 @@ def test_ibootstrap():
                file.write('C3[%.2i][%.2i]: %f\n' % (t,t1,(4.0+random.gauss(0,0.05*(2+t+t1)))*exp(-0.2*(t+t1))))
     file.close()
     IBootstrap('test_samples.log','"C3[<t1>][<t2>]"/"C2[<t1>]"/"C2[<t2>]"','t1==t2',0,0,100).log_report()    
+    for mode in IBootstrap.MODES[1:]:
+        b=IBootstrap('test_samples.log','"C2[<t>]"','t<3',0,0,100,mode=mode)
+        if b.status!='success': raise RuntimeError, 'mode %s failed' % mode
+        b.log_report()
+    for mode in ('block','block_jackknife'):
+        b=IBootstrap('test_samples.log','"C2[<t>]"','t<3',0,0,100,mode=mode,block_size=1000)
+        if b.status!='success' or not numpy.isfinite(b.min_mean_max.values()).all():
+            raise RuntimeError, 'mode %s failed with a large block size' % mode
+    if IBootstrap('test_samples.log','"C2[<t>]"','t<3',0,1,100,mode='jackknife').status!='failure':
+        raise RuntimeError, 'jackknife of one measurement did not fail'
+    for expression in ('log("C2[<t>]"-1.9)','1/("C2[<t>]"-"C2[<t>]")','sqrt("C2[<t>]"-2)'):
+        if IBootstrap('test_samples.log',expression,'True',0,0,100).status!='failure':
+            raise RuntimeError, 'domain error in %s not reported' % expression
+    a=IBootstrap('test_samples.log','"C2[<t>]"','t<3',0,0,100,storage='both',
+                 window=10,alpha=0.1,seed=1)
+    b=IBootstrap('qcdutils_raw_data.bin','"C2[<t>]"','t<3',0,0,100,raw=True)
+    if not numpy.array_equal(a.data,b.data):
+        raise RuntimeError, 'binary raw data differ from parsed data'
+    b=IBootstrap('test_samples.log','"C2[<t>]"','t<3',0,0,100,processes=2,seed=1)
+    if a.samples!=b.samples:
+        raise RuntimeError, 'seeded samples depend on the number of processes'
+    open('test_manifest.csv','w').write('pattern,beta\ntest_samples.log,5.7\ntest_samples.log,6.0\n')
+    run_ensembles('test_manifest.csv','"C2[<t>]"','t<3',output_prefix='test')
+    if len(open('test_ensembles.csv').readlines())!=7:
+        raise RuntimeError, 'wrong number of ensemble results'
+    keys, covariance = read_columns('qcdutils_covariance.bin')
+    if abs(covariance[0,0]-numpy.var(a.samples[keys[0]],ddof=1))>1e-12:
+        raise RuntimeError, 'wrong covariance'
     return 0
 
 def shell_ibootstrap():
@@ -382,6 +1068,24 @@ def shell_ibootstrap():
 		      help='number of required bootstrap samples')
     parser.add_option('-p','--percentage',default='0.158',dest='percent',
 		      help='percentage in the lower and upper tails')
+    parser.add_option('-m','--mode',default='bootstrap',dest='mode',
+		      help='resampling mode: bootstrap, block, moving_block, jackknife or block_jackknife')
+    parser.add_option('-k','--block_size',default='0',dest='block_size',
+		      help='block size for block modes (default is 2*tau_int)')
+    parser.add_option('-j','--processes',default='1',dest='processes',
+		      help='number of processes used to parse the log files, bootstrap and run ensembles')
+    parser.add_option('-u','--state',default=None,dest='state_file',
+		      help='state file to parse only what was appended to the logs since the last run')
+    parser.add_option('-s','--storage',default='csv',dest='storage',
+		      help='format of raw data, samples and trails: csv, bin or both')
+    parser.add_option('-w','--window',default='0',dest='window',
+		      help='also save trails of averages over the last window steps')
+    parser.add_option('-x','--ewma',default='0',dest='alpha',
+		      help='also save trails of exponentially weighted averages with weight alpha')
+    parser.add_option('-d','--seed',default=None,dest='seed',
+		      help='seed of the random numbers, to make results reproducible')
+    parser.add_option('-f','--manifest',default=None,dest='manifest',
+		      help='csv file of ensembles: file pattern and parameters; the file pattern argument is then omitted')
     parser.add_option('-t','--test',action='store_true',dest='test',
 		      default=False,help='make a test!')
     parser.add_option('-r','--raw',action='store_true',dest='raw',
@@ -394,13 +1098,36 @@ def shell_ibootstrap():
 		      default='qcdutils',help='path+prefix used to build output files')
     (options, args) = parser.parse_args()
     if options.test: return test_ibootstrap()
+    if options.manifest:
+        if len(args)<1: return 1
+        results=run_ensembles(options.manifest,args[0],
+                              args[1] if len(args)>1 else 'True',
+                              int(options.processes),options.output_prefix,
+                              min_index=int(options.min),max_index=int(options.max),
+                              nsamples=int(options.nsamples),percent=float(options.percent),
+                              raw=options.raw,advanced=options.advanced,
+                              import_module=options.import_module,mode=options.mode,
+                              block_size=int(options.block_size),
+                              state_file=options.state_file,storage=options.storage,
+                              window=int(options.window),alpha=float(options.alpha),
+                              seed=int(options.seed) if options.seed else None)
+        for filepattern,status,report in results:
+            print 'ensemble %s: %s' % (filepattern,status)
+            for msg in report: print '  %s' % msg
+        print 'results saved in %s_ensembles.csv' % options.output_prefix
+        if [status for filepattern,status,report in results if status=='failure']: return 1
+        return 0
     if len(args)<2: return 1
     if len(args)<3: args.append('True')
     ibootstrap=IBootstrap(args[0],args[1],args[2],
 			  int(options.min),int(options.max),  
 			  int(options.nsamples),float(options.percent),
 			  options.output_prefix,
-                          options.raw,options.advanced,options.import_module)
+                          options.raw,options.advanced,options.import_module,
+                          None,options.mode,int(options.block_size),
+                          int(options.processes),options.state_file,
+                          options.storage,int(options.window),float(options.alpha),
+                          int(options.seed) if options.seed else None)
     ibootstrap.log_report()
     if ibootstrap.status=='failure': return 1
     return 0
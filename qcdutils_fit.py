@@ -6,10 +6,11 @@
 ### TODO... integrate qcdutils_fit with qcdutils_plot
 
 from math import *
-import re, random, copy, sys, csv
+import re, random, copy, sys, csv, multiprocessing
 from optparse import *
+import numpy
 from numpy import matrix
-from numpy.linalg import *
+from numpy.linalg import inv, solve, cholesky, LinAlgError
 try:
     from qcdutils_plot import draw
 except ImportError:
@@ -34,7 +35,8 @@ version = \
 description = \
     "This program takes data produced by qcdutils and fits it\n" \
     "it also does correlated fits by using the built-in function\n" \
-    "(a==b)"
+    "(a==b) or, with --samples or --covariance, by minimizing the\n" \
+    "chi2 with the inverse covariance matrix of the points"
 
 def partial(f,i,h=1e-4):
     """
@@ -62,7 +64,7 @@ def hessian(f, x, h=1e-4):
     """
     s = xrange(len(x))
     grad = [partial(f,r,h) for r in s]
-    return matrix([[partial(grad[r],r,h)(x) for c in s] for r in s])
+    return matrix([[partial(grad[r],c,h)(x) for c in s] for r in s])
 
 def norm(A):
     """
@@ -76,21 +78,191 @@ def tolist(A):
     rows, cols = A.shape
     return [A[r,0] for r in xrange(rows)]
 
-def optimize_newton_multi_imporved(f, x, ap=1e-6, rp=1e-4, ns=200):
+def _grow(a, lead, ndim):
+    """reshapes a, of shape lead dimensions + shape, to have ndim trailing dimensions"""
+    extra = ndim - (a.ndim - lead)
+    if extra > 0:
+        a = a.reshape(a.shape[:lead]+(1,)*extra+a.shape[lead:])
+    return a
+
+def _outer(u, v):
+    return u[:,None]*v[None,:]
+
+class Dual(object):
+    """
+    a value together with its gradient and hessian with respect to n
+    parameters (forward mode automatic differentiation, to second order).
+    value can also be a numpy array, one value per data point; then
+    gradient has shape (n,)+value.shape and hessian (n,n)+value.shape.
+    Functions of Duals are in DUAL_FUNCTIONS.
+
+    >>> a, b = Dual.variables([2.0, 3.0])
+    >>> c = a*a*b+1/b
+    >>> print c.value, numpy.round(c.gradient,4).tolist(), numpy.round(c.hessian,4).tolist()
+    12.3333333333 [12.0, 3.8889] [[6.0, 4.0], [4.0, 0.0741]]
+    """
+    __array_ufunc__ = None # so that numpy arrays leave operations to Dual
+
+    def __init__(self, value, gradient, hessian):
+        self.value = value
+        self.gradient = gradient
+        self.hessian = hessian
+
+    @staticmethod
+    def variables(values, hessian=True):
+        """the parameters, as Duals (without hessian if not hessian)"""
+        n = len(values)
+        identity, zero = numpy.eye(n), (numpy.zeros((n,n)) if hessian else None)
+        return [Dual(float(v),identity[i],zero) for i,v in enumerate(values)]
+
+    def apply(self, other, value, da, db=None, daa=None, dab=None, dbb=None):
+        """
+        the Dual of value = phi(self, other) given the first and second
+        derivatives of phi. other can be a constant, or None for functions
+        of self only
+        """
+        ndim = numpy.ndim(value)
+        n = self.gradient.shape[0]
+        shape = numpy.shape(value)
+        if self.hessian is None: # first derivatives only
+            gradient = da*_grow(self.gradient,1,ndim)
+            if isinstance(other, Dual):
+                gradient = gradient + db*_grow(other.gradient,1,ndim)
+            return Dual(value, numpy.broadcast_to(gradient,(n,)+shape), None)
+        ga, ha = _grow(self.gradient,1,ndim), _grow(self.hessian,2,ndim)
+        gradient, hessian = da*ga, da*ha
+        if daa is not None:
+            hessian = hessian + daa*_outer(ga,ga)
+        if isinstance(other, Dual):
+            gb, hb = _grow(other.gradient,1,ndim), _grow(other.hessian,2,ndim)
+            gradient, hessian = gradient + db*gb, hessian + db*hb
+            if dab is not None:
+                cross = _outer(ga,gb)
+                hessian = hessian + dab*(cross+cross.swapaxes(0,1))
+            if dbb is not None:
+                hessian = hessian + dbb*_outer(gb,gb)
+        gradient = numpy.broadcast_to(gradient,(n,)+shape)
+        hessian = numpy.broadcast_to(hessian,(n,n)+shape)
+        return Dual(value, gradient, hessian)
+
+    def __add__(self, other):
+        return self.apply(other, self.value+_value(other), 1.0, 1.0)
+    __radd__ = __add__
+    def __sub__(self, other):
+        return self.apply(other, self.value-_value(other), 1.0, -1.0)
+    def __rsub__(self, other):
+        return self.apply(None, other-self.value, -1.0)
+    def __mul__(self, other):
+        b = _value(other)
+        return self.apply(other, self.value*b, b, self.value, None, 1.0)
+    __rmul__ = __mul__
+    def __div__(self, other):
+        a, b = self.value, _value(other)
+        return self.apply(other, a/b, 1.0/b, -a/b**2, None, -1.0/b**2, 2.0*a/b**3)
+    __truediv__ = __div__
+    def __rdiv__(self, other):
+        a = self.value
+        return self.apply(None, other/a, -other/a**2, None, 2.0*other/a**3)
+    __rtruediv__ = __rdiv__
+    def __pow__(self, other):
+        a, b = self.value, _value(other)
+        if not isinstance(other, Dual):
+            return self.apply(None, a**b, b*a**(b-1), None, b*(b-1)*a**(b-2))
+        c, l = a**b, numpy.log(a)
+        return self.apply(other, c, b*a**(b-1), c*l, b*(b-1)*a**(b-2),
+                          a**(b-1)*(1+b*l), c*l*l)
+    def __rpow__(self, other):
+        c, l = other**self.value, numpy.log(other)
+        return self.apply(None, c, c*l, None, c*l*l)
+    def __neg__(self):
+        return self.apply(None, -self.value, -1.0)
+    def __pos__(self):
+        return self
+    def __abs__(self):
+        return self.apply(None, abs(self.value), numpy.sign(self.value))
+    def __lt__(self, other): return self.value < _value(other)
+    def __le__(self, other): return self.value <= _value(other)
+    def __gt__(self, other): return self.value > _value(other)
+    def __ge__(self, other): return self.value >= _value(other)
+    def __eq__(self, other): return self.value == _value(other)
+    def __ne__(self, other): return self.value != _value(other)
+    __hash__ = None
+
+    def transform(self, m):
+        """the Dual of numpy.dot(m, value) for a constant matrix m"""
+        value = numpy.dot(m, self.value)
+        gradient = numpy.dot(self.gradient, m.T)
+        hessian = None if self.hessian is None else numpy.dot(self.hessian, m.T)
+        return Dual(value, gradient, hessian)
+
+    def sum(self):
+        """sum over the data points"""
+        return Dual(numpy.sum(self.value),
+                    self.gradient.reshape(self.gradient.shape[:1]+(-1,)).sum(1),
+                    self.hessian.reshape(self.hessian.shape[:2]+(-1,)).sum(2))
+
+    def __repr__(self):
+        return 'Dual(%r, %r, %r)' % (self.value, self.gradient, self.hessian)
+
+def _value(x):
+    return x.value if isinstance(x, Dual) else x
+
+def _dual_function(name, derivatives):
+    """
+    a function which works on floats, numpy arrays and Duals, given its
+    value and first and second derivatives as a function of x
+    """
+    function = getattr(numpy, name)
+    def f(x):
+        if isinstance(x, Dual):
+            value, d1, d2 = derivatives(x.value)
+            return x.apply(None, value, d1, None, d2)
+        return function(x)
+    f.__name__ = name
+    return f
+
+def _tan(x):
+    t = numpy.tan(x)
+    return t, 1+t*t, 2*t*(1+t*t)
+
+def _tanh(x):
+    t = numpy.tanh(x)
+    return t, 1-t*t, -2*t*(1-t*t)
+
+DUAL_FUNCTIONS = dict(
+    exp = _dual_function('exp', lambda x: (numpy.exp(x),)*3),
+    log = _dual_function('log', lambda x: (numpy.log(x), 1.0/x, -1.0/x**2)),
+    sqrt = _dual_function('sqrt', lambda x: (numpy.sqrt(x), 0.5/numpy.sqrt(x),
+                                             -0.25/numpy.sqrt(x)**3)),
+    sin = _dual_function('sin', lambda x: (numpy.sin(x), numpy.cos(x), -numpy.sin(x))),
+    cos = _dual_function('cos', lambda x: (numpy.cos(x), -numpy.sin(x), -numpy.cos(x))),
+    tan = _dual_function('tan', _tan),
+    sinh = _dual_function('sinh', lambda x: (numpy.sinh(x), numpy.cosh(x), numpy.sinh(x))),
+    cosh = _dual_function('cosh', lambda x: (numpy.cosh(x), numpy.sinh(x), numpy.cosh(x))),
+    tanh = _dual_function('tanh', _tanh),
+    atan = _dual_function('arctan', lambda x: (numpy.arctan(x), 1.0/(1+x*x),
+                                               -2*x/(1+x*x)**2)),
+    fabs = _dual_function('fabs', lambda x: (numpy.fabs(x), numpy.sign(x), 0.0)),
+    pow = lambda x, y: x**y)
+
+def optimize_newton_multi_imporved(f, x, ap=1e-6, rp=1e-4, ns=200, derivatives=None):
     """
     Multidimensional Newton optimizer
     on failure is performs a steepest descent
+    derivatives(x), if given, returns the gradient and the hessian of f in x,
+    otherwise they are computed by finite differences
     """
+    if not derivatives:
+        derivatives = lambda x: (gradient(f,x), hessian(f,x))
     fx = f(x)
     x = matrix([[element] for element in x])
     h = 10.0
     for k in xrange(ns):
         print tolist(x), fx
-        grad = gradient(f,tolist(x))
-        (grad,H) = (gradient(f,tolist(x)), hessian(f,tolist(x)))
+        (grad,H) = derivatives(tolist(x))
         if norm(H) < ap:
             raise ArithmeticError, 'unstable solution'
-        (fx_old, x_old, x) = (fx, x, x-(1.0/H)*grad)
+        (fx_old, x_old, x) = (fx, x, x-H.I*grad)
         fx = f(tolist(x))
         while fx>fx_old: # revert to steepest descent
             (fx, x) = (fx_old, x_old)
@@ -101,20 +273,163 @@ def optimize_newton_multi_imporved(f, x, ap=1e-6, rp=1e-4, ns=200):
         h = norm(x-x_old)*2
         if k>2 and h/2<max(ap,norm(x)*rp):
             x = tolist(x)
-            return x, hessian(f,x)
+            return x, derivatives(x)[1]
     raise ArithmeticError, 'no convergence'
 
+def optimize_levenberg_marquardt(residuals, jacobian, x, ap=1e-6, rp=1e-4, ns=200,
+                                 bounds=None, verbose=False):
+    """
+    Levenberg-Marquardt minimization of sum(residuals(x)**2), where
+    jacobian(x) is the (npoints, nparameters) matrix of derivatives of the
+    residuals. The damping adapts: it is reduced after a step that lowers
+    chi2, increased otherwise. bounds, if given, is a pair of arrays of
+    lower and upper limits (-inf, inf for none) and steps are projected
+    inside them. Returns x, chi2, J^T J and a dict of diagnostics
+    (iterations, evaluations, converged, message); J^T J inverted is the
+    covariance of the parameters.
+    Raises ArithmeticError if it does not converge in ns iterations.
+    """
+    x = numpy.array(x, dtype=float)
+    if bounds:
+        lower, upper = bounds
+        x = numpy.clip(x, lower, upper)
+    r = residuals(x)
+    chi2 = numpy.dot(r,r)
+    J = jacobian(x)
+    lam = 1e-3
+    info = dict(iterations=0, evaluations=1, converged=False, message='')
+    for k in xrange(ns):
+        info['iterations'] = k+1
+        A, g = numpy.dot(J.T,J), numpy.dot(J.T,r)
+        d = A.diagonal().copy()
+        d[d<=0] = max(d.max(),1.0)*1e-12
+        while True:
+            try:
+                dx = numpy.linalg.solve(A+lam*numpy.diag(d), -g)
+            except numpy.linalg.LinAlgError:
+                lam *= 10
+                continue
+            x_new = x+dx
+            if bounds:
+                x_new = numpy.clip(x_new, lower, upper)
+            r_new = residuals(x_new)
+            chi2_new = numpy.dot(r_new,r_new)
+            info['evaluations'] += 1
+            if verbose:
+                print 'LM %i: chi2=%g lambda=%g x=%s' % (k, chi2_new, lam, x_new.tolist())
+            if chi2_new <= chi2 or lam > 1e16:
+                break
+            lam *= 10
+        if chi2_new > chi2:
+            info.update(converged=True, message='no further decrease of chi2')
+            break
+        step = numpy.abs(x_new-x).max()
+        decrease = chi2-chi2_new
+        (x, r, chi2) = (x_new, r_new, chi2_new)
+        J = jacobian(x)
+        lam = max(lam/10, 1e-12)
+        if step < max(ap, rp*numpy.abs(x).max()) and decrease <= rp*chi2 or \
+                decrease <= 1e-12*chi2:
+            info.update(converged=True, message='converged')
+            break
+    if not info['converged']:
+        raise ArithmeticError, 'no convergence'
+    return x, chi2, numpy.dot(J.T,J), info
 
-def fit(data, f, b, ap=1e-6, rp=1e-4, ns=200, bayesian=None):
+def fit(data, f, b, ap=1e-6, rp=1e-4, ns=200, bayesian=None, derivatives=None):
     def g(b,data=data,f=f,bayesian=bayesian):
         chi2 = sum(((y-f(x,b))/dy)**2 for x,y,dy in data)
         if bayesian:
             chi2 += bayesian(b)
         return chi2
-    b, H = optimize_newton_multi_imporved(g,b,ap,rp,ns)
+    b, H = optimize_newton_multi_imporved(g,b,ap,rp,ns,derivatives)
     chi2 = sum(((y-f(x,b))/dy)**2 for x,y,dy in data)
     return b, chi2, H
 
+def shrink_covariance(covariance, samples=None, shrinkage=None, svdcut=0.0):
+    """
+    regularizes a covariance matrix, in terms of the correlation matrix R.
+    shrinkage='ledoit-wolf' replaces R with d*1+(1-d)*R, where d is the
+    Ledoit-Wolf estimate computed from samples (one row per point);
+    eigenvalues of R below svdcut times the largest one are raised to it.
+
+    >>> C = shrink_covariance(numpy.array([[4.0,2.0],[2.0,1.0]]), svdcut=0.1)
+    >>> print numpy.round(C,4).tolist()
+    [[4.4, 1.8], [1.8, 1.1]]
+    """
+    covariance = numpy.array(covariance, dtype=float)
+    sd = numpy.sqrt(covariance.diagonal())
+    R = covariance/numpy.outer(sd,sd)
+    if shrinkage == 'ledoit-wolf':
+        if samples is None:
+            raise RuntimeError, 'ledoit-wolf shrinkage requires samples'
+        X = numpy.array(samples, dtype=float)
+        X = X-X.mean(1).reshape(-1,1)
+        X = X/numpy.sqrt((X*X).mean(1)).reshape(-1,1)
+        (p, n) = X.shape
+        S = numpy.dot(X,X.T)/n
+        d2 = ((S-numpy.eye(p))**2).sum()/p
+        b2 = (((X*X).sum(0)**2).sum()/n-(S*S).sum())/n/p
+        d = min(b2,d2)/d2 if d2 else 1.0
+        R = d*numpy.eye(p)+(1.0-d)*R
+    elif shrinkage:
+        raise RuntimeError, 'unknown shrinkage %s' % shrinkage
+    if svdcut:
+        w, v = numpy.linalg.eigh(R)
+        w = numpy.maximum(w, svdcut*w.max())
+        R = numpy.dot(v*w,v.T)
+    return R*numpy.outer(sd,sd)
+
+SHARED = {} # state inherited by the refitting worker processes
+
+def refit_sample(j):
+    """
+    refits the fitter in SHARED on the j-th column of its samples, starting
+    from the central values; returns the parameters followed by chi2, or
+    None if the fit fails
+    """
+    fitter, y = SHARED['fitter'], SHARED['samples'][:,j]
+    fitter.y = y
+    fitter.data = [(x,yj,dy) for (x,old,dy),yj in zip(SHARED['data'],y)]
+    try:
+        b, chi2, H = fitter.fit(**SHARED['values'])
+    except (ArithmeticError, LinAlgError):
+        return None
+    return [b[v] for v in fitter.variables]+[chi2]
+
+def refine_start(values):
+    """
+    fits the fitter in SHARED starting from values, returns the values
+    of the parameters and chi2, or None if the fit fails
+    """
+    try:
+        with numpy.errstate(over='ignore',invalid='ignore'):
+            b, chi2, H = SHARED['fitter'].fit(**values)
+    except (ArithmeticError, LinAlgError):
+        return None
+    return b, chi2
+
+def latin_hypercube(ranges,n,rng):
+    """
+    n points in the box ranges=[(lower,upper),...], one in each of the n
+    slices of every range, as an (n,len(ranges)) array
+    """
+    points = numpy.empty((n,len(ranges)))
+    for i,(lower,upper) in enumerate(ranges):
+        u = (rng.permutation(n)+rng.uniform(size=n))/n
+        points[:,i] = lower+(upper-lower)*u
+    return points
+
+def grid(ranges,n):
+    """
+    the n**len(ranges) points of a regular grid in the box ranges
+
+    >>> print grid([(0,1),(2,3)],2).tolist()
+    [[0.0, 2.0], [0.0, 3.0], [1.0, 2.0], [1.0, 3.0]]
+    """
+    axes = [numpy.linspace(lower,upper,n) for lower,upper in ranges]
+    return numpy.array([a.ravel() for a in numpy.meshgrid(*axes,indexing='ij')]).T
+
 class Fitter(object):
     def __init__(self,expression,points,symbols=None,
                  condition='True',modules=None):
@@ -133,13 +448,20 @@ class Fitter(object):
         self.locals = {}             # {'exp':<function...>}
         for module in modules:
             exec("from %s import *" % module) in self.locals
+        for name, function in DUAL_FUNCTIONS.items():
+            # math functions are replaced by versions which accept Duals
+            if self.locals.get(name, None) is globals().get(name, 0):
+                self.locals[name] = function
         self.data = []               # [((x,y),o,do) for x,y,o,do in points]
+        self.selected = []           # indices in points of the data
         nx = len(symbols)            # 2
-        self.variables = [           # ['a','b']
-            key for key in re.compile('[a-zA-Z_]+\w*').findall(expression) \
-                if not key in self.locals and not key in symbols and not key in \
-                ('is', 'if','else','int','float','div')]
-        for point in points:
+        self.variables = []          # ['a','b']
+        for key in re.compile('[a-zA-Z_]+\w*').findall(expression):
+            if not key in self.locals and not key in symbols and not key in \
+                    ('is', 'if','else','int','float','div') and \
+                    not key in self.variables:
+                self.variables.append(key)
+        for index, point in enumerate(points):
             symbol_dict = {}
             for i,symbol in enumerate(symbols):                
                 symbol_dict[symbol] = point[i]
@@ -150,10 +472,123 @@ class Fitter(object):
                 else:
                     raise ArithmeticError, "oops"
                 self.data.append((symbol_dict,point[nx+1],err))
+                self.selected.append(index)
         self.values = {}
+        self.bounds = {}             # {'a':(0,None), 'b':(-1,1)}
         self.ap=1e-6
         self.rp=1e-4
         self.ns=1000
+        self.method='lm'             # or 'newton'
+        self.verbose=False
+        # the model compiled once and the data as arrays, one entry per point
+        self.code = compile(expression, expression, 'eval')
+        self.arrays = dict((symbol, numpy.array([x[symbol] for x,y,dy in self.data])) \
+                               for symbol in symbols)
+        self.y = numpy.array([y for x,y,dy in self.data], dtype=float)
+        self.dy = numpy.array([dy for x,y,dy in self.data], dtype=float)
+        self.whitening = None        # L^-1 where L L^T is the covariance
+
+    def correlate(self,covariance=None,samples=None,shrinkage=None,svdcut=0.0):
+        """
+        makes the fit correlated: chi2 = (y-f)^T C^-1 (y-f) = |L^-1 (y-f)|^2
+        where C = L L^T is the covariance of the points (as in self.points)
+        or, if not given, the covariance of their samples, regularized by
+        shrink_covariance. C is factorized only once, here.
+        """
+        if samples is not None:
+            samples = numpy.asarray(samples, dtype=float)[self.selected]
+        if covariance is None:
+            covariance = numpy.cov(samples)
+        else:
+            covariance = numpy.asarray(covariance, dtype=float)
+            covariance = covariance[self.selected][:,self.selected]
+        covariance = shrink_covariance(covariance,samples,shrinkage,svdcut)
+        try:
+            L = cholesky(covariance)
+        except LinAlgError:
+            raise ArithmeticError, 'covariance is not positive definite, use svdcut'
+        self.whitening = solve(L, numpy.eye(len(L)))
+
+    def weight(self,d):
+        """
+        residuals from the deviations d = y-f(x,b) of the data points, along
+        the first axis of d: d/dy or, in correlated fits, L^-1 d
+        """
+        if self.whitening is None:
+            if isinstance(d, Dual):
+                return d/self.dy
+            return d/self.dy.reshape((-1,)+(1,)*(numpy.ndim(d)-1))
+        if isinstance(d, Dual):
+            return d.transform(self.whitening)
+        return numpy.dot(self.whitening, d)
+
+    def model(self,b):
+        """
+        values of the model at all data points at once, where b are the
+        values of self.variables (floats or Duals)
+        """
+        values = dict(self.arrays)
+        values.update(zip(self.variables, b))
+        return eval(self.code, self.locals, values)
+
+    def residuals(self,b):
+        """(y-f(x,b))/dy at all data points, whitened in correlated fits"""
+        d = self.y-self.model(b)
+        if self.whitening is not None and not isinstance(d, Dual):
+            d = numpy.broadcast_to(d, self.y.shape)
+        return self.weight(d)
+
+    def chi2(self,b,priors=True):
+        r = self.residuals(b)
+        chi2 = float(numpy.dot(r,r)) if numpy.ndim(r) else len(self.y)*r*r
+        if priors and self.priors:
+            chi2 += self.bayesian(b)
+        return chi2
+
+    def prior_residuals(self,b):
+        return [(b[i]-self.priors[v][0])/self.priors[v][1] \
+                    for i,v in enumerate(self.variables) if v in self.priors]
+
+    def all_residuals(self,b):
+        """residuals of all points followed by one residual per prior"""
+        if self.vectorized:
+            r = numpy.broadcast_to(self.residuals(b),self.y.shape)
+        else:
+            r = self.weight(numpy.array([y-self.f(x,b) for x,y,dy in self.data]))
+        return numpy.concatenate((r,self.prior_residuals(b)))
+
+    def jacobian(self,b):
+        """
+        derivatives of all_residuals with respect to the parameters, by
+        automatic differentiation or, if the model rejects Duals, by finite
+        differences
+        """
+        n = len(b)
+        try:
+            duals = Dual.variables(b, hessian=False)
+            if self.vectorized:
+                J = numpy.broadcast_to(self.residuals(duals).gradient,(n,len(self.y))).T
+            else:
+                J = self.weight(numpy.array([(y-self.f(x,duals)).gradient \
+                                                 for x,y,dy in self.data]).reshape(-1,n))
+            priors = [r.gradient for r in self.prior_residuals(duals)]
+            return numpy.vstack([J]+priors) if priors else numpy.array(J)
+        except (TypeError, AttributeError):
+            h = 1e-6*numpy.maximum(numpy.abs(b),1.0)
+            columns = []
+            for i in range(n):
+                u, v = numpy.array(b,dtype=float), numpy.array(b,dtype=float)
+                u[i] += h[i]
+                v[i] -= h[i]
+                columns.append((self.all_residuals(u)-self.all_residuals(v))/(2*h[i]))
+            return numpy.array(columns).T
+
+    def is_vectorized(self,b):
+        """true if the model can be evaluated on all data points at once"""
+        try:
+            return numpy.shape(self.residuals(b)) == self.y.shape
+        except Exception:
+            return False
 
     def f(self,x,b):
         """
@@ -173,16 +608,167 @@ class Fitter(object):
                 dchi2 += ((b[i]-b0)/db)**2
         return dchi2
 
+    def derivatives(self,b):
+        """
+        exact gradient and hessian of chi2 in b, by automatic differentiation
+        """
+        duals = Dual.variables(b)
+        if self.vectorized:
+            r = self.residuals(duals)
+            chi2 = (r*r).sum()
+        else:
+            chi2 = sum(((y-self.f(x,duals))/dy)**2 for x,y,dy in self.data)
+        if self.priors:
+            chi2 = chi2 + self.bayesian(duals)
+        return matrix(chi2.gradient).T, matrix(chi2.hessian)
+
     def fit(self,**initial_values):
         b = [initial_values[bi] for bi in self.variables]
         for key,value in initial_values.items():
             if key[0]=='_':
                 self.priors[key[1:]]=(initial_values[key[1:]], value)
-        b, chi2, H = fit(self.data,self.f,b,ap=self.ap, rp=self.rp, ns=self.ns, 
-                         bayesian=self.priors and self.bayesian)
+        self.vectorized = self.is_vectorized(b)
+        if self.method=='lm':
+            inf = float('inf')
+            lower = numpy.array([self.bounds.get(v,(None,None))[0] for v in self.variables])
+            upper = numpy.array([self.bounds.get(v,(None,None))[1] for v in self.variables])
+            lower = numpy.where(numpy.equal(lower,None),-inf,lower).astype(float)
+            upper = numpy.where(numpy.equal(upper,None),inf,upper).astype(float)
+            b, chi2, JTJ, self.info = optimize_levenberg_marquardt(
+                self.all_residuals,self.jacobian,b,self.ap,self.rp,self.ns,
+                bounds=(lower,upper) if self.bounds else None,verbose=self.verbose)
+            b = b.tolist()
+            self.covariance = matrix(numpy.linalg.pinv(JTJ))
+            H = matrix(2*JTJ) # the Gauss-Newton hessian of chi2
+            r = self.all_residuals(b)[:len(self.y)]
+            chi2 = float(numpy.dot(r,r))
+            self.locals.update(zip(self.variables,b))
+            b = dict((v,b[i]) for (i,v) in enumerate(self.variables))
+            return b, chi2, H
+        try:
+            self.derivatives(b)
+            derivatives = self.derivatives
+        except (TypeError, AttributeError):
+            # the model uses functions which do not accept Duals
+            derivatives = None
+        if self.vectorized:
+            b, H = optimize_newton_multi_imporved(self.chi2,b,self.ap,self.rp,
+                                                  self.ns,derivatives)
+            chi2 = self.chi2(b,priors=False)
+            self.locals.update(zip(self.variables,b))
+        elif self.whitening is not None:
+            g = lambda b: float(numpy.dot(*[self.all_residuals(b)]*2))
+            b, H = optimize_newton_multi_imporved(g,b,self.ap,self.rp,self.ns)
+            r = self.all_residuals(b)[:len(self.y)]
+            chi2 = float(numpy.dot(r,r))
+            self.locals.update(zip(self.variables,b))
+        else:
+            b, chi2, H = fit(self.data,self.f,b,ap=self.ap, rp=self.rp, ns=self.ns, 
+                             bayesian=self.priors and self.bayesian,
+                             derivatives=derivatives)
+        self.covariance = matrix(2*numpy.linalg.pinv(H))
         b = dict((v,b[i]) for (i,v) in enumerate(self.variables))
         return b, chi2, H
 
+    def batch_chi2(self,candidates):
+        """
+        chi2 of every row of candidates (values of self.variables), by
+        broadcasting the model over all candidates at once if possible
+        """
+        candidates = numpy.asarray(candidates,dtype=float)
+        try:
+            b = [c.reshape(-1,1) for c in candidates.T]
+            with numpy.errstate(over='ignore',invalid='ignore'):
+                d = numpy.broadcast_to(self.y-self.model(b),(len(candidates),len(self.y)))
+            r = self.weight(d.T)
+            chi2 = (r*r).sum(0)
+            if self.priors:
+                chi2 = chi2+numpy.ravel(self.bayesian(b))
+        except Exception:
+            # the model does not broadcast, one candidate at a time
+            chi2 = []
+            for b in candidates:
+                try:
+                    r = self.all_residuals(b)
+                    chi2.append(float(numpy.dot(r,r)))
+                except (ArithmeticError, ValueError):
+                    chi2.append(float('inf'))
+            chi2 = numpy.array(chi2)
+        return numpy.where(numpy.isnan(chi2),float('inf'),chi2)
+
+    def multistart(self,ranges,initial_values,n=100,keep=5,
+                   use_grid=False,processes=1,seed=0):
+        """
+        global search of the starting point: evaluates chi2 on n points
+        (a latin hypercube or, if use_grid, n points per range on a grid)
+        in the ranges {variable:(lower,upper)}, where the other variables
+        keep their initial_values, then fits from the best keep points, in
+        parallel if processes>1. Returns the best fit as fit does
+        """
+        initial_values = dict(initial_values)
+        for key in initial_values.keys():
+            if key[0]=='_':
+                self.priors[key[1:]]=(initial_values[key[1:]], initial_values.pop(key))
+        self.vectorized = self.is_vectorized([initial_values[v] for v in self.variables])
+        names = [v for v in self.variables if v in ranges]
+        boxes = [ranges[v] for v in names]
+        if use_grid:
+            points = grid(boxes,n)
+        else:
+            points = latin_hypercube(boxes,n,numpy.random.RandomState(seed))
+        candidates = numpy.array([[initial_values[v] for v in self.variables]]*len(points))
+        for i,v in enumerate(names):
+            candidates[:,self.variables.index(v)] = points[:,i]
+        chi2 = self.batch_chi2(candidates)
+        starts = [dict(zip(self.variables,candidates[i])) \
+                      for i in numpy.argsort(chi2)[:keep]]
+        SHARED.update(fitter=self)
+        try:
+            if processes>1 and len(starts)>1:
+                pool = multiprocessing.Pool(processes)
+                try:
+                    results = pool.map(refine_start,starts)
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                results = map(refine_start,starts)
+        finally:
+            SHARED.clear()
+        results = [r for r in results if r is not None]
+        if not results:
+            raise ArithmeticError, 'no convergence from any start'
+        best = min(results,key=lambda r: r[1])[0]
+        return self.fit(**best)
+
+    def bootstrap(self,samples,values,processes=1):
+        """
+        refits every bootstrap sample, the columns of samples (one row per
+        point, as in self.points), each starting from values (the central
+        fit), in parallel if processes>1. Returns one row per sample that
+        converged: the parameters (as in self.variables) followed by chi2
+        """
+        samples = numpy.asarray(samples,dtype=float)[self.selected]
+        state = (self.y, self.data, self.covariance, getattr(self,'info',None))
+        SHARED.update(fitter=self,samples=samples,data=self.data,
+                      values=dict((v,values[v]) for v in self.variables))
+        jobs = range(samples.shape[1])
+        try:
+            if processes>1 and len(jobs)>1:
+                pool = multiprocessing.Pool(processes)
+                try:
+                    results = pool.map(refit_sample,jobs)
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                results = map(refit_sample,jobs)
+        finally:
+            SHARED.clear()
+            (self.y, self.data, self.covariance, self.info) = state
+            self.locals.update(values)
+        return numpy.array([r for r in results if r is not None]).reshape(-1,len(self.variables)+1)
+
     def extrapolate(self,**x):
         """                                                    
         assuming a fit has been done... extrapolate to the point at coordinates
@@ -212,10 +798,11 @@ def test():
     print fitter.extrapolate(x=11,y=11)
 
 
-def read_min_mean_max_file(filename):
+def read_min_mean_max_file(filename,keys=False):
     """
     reads a standard qcdutils_results.csv file,
     extract all the points and symetrizes the error bars
+    (and, if keys, also returns the key of each point)
     """
     reader=csv.reader(open(filename,'r'),delimiter=',',
                       quoting=csv.QUOTE_NONNUMERIC)
@@ -227,8 +814,154 @@ def read_min_mean_max_file(filename):
 	    break
     i+=3
     points=[line[1:] for line in lines[1:]]
+    if keys:
+        return symbols,points,[line[0] for line in lines[1:]]
     return symbols,points
 
+def read_keyed_rows(filename):
+    """
+    reads rows {key:values} saved by qcdutils_boot.py, as csv or as
+    binary columns, returns the keys and a (len(keys),columns) array
+    """
+    from qcdutils_boot import is_columns_file, read_columns
+    if is_columns_file(filename):
+        keys, data = read_columns(filename)
+        return keys, numpy.array(data)
+    reader=csv.reader(open(filename,'r'),delimiter=',',
+                      quoting=csv.QUOTE_NONNUMERIC)
+    rows=[row for row in reader if row]
+    return [row[0] for row in rows], numpy.array([row[1:] for row in rows])
+
+def read_covariance(keys,samples=None,covariance=None):
+    """
+    reads the bootstrap samples (qcdutils_samples.csv or .bin) or the
+    covariance matrix (qcdutils_covariance.bin) of the points with the
+    given keys, returns covariance (None if from samples) and samples
+    """
+    result = []
+    for filename in (covariance,samples):
+        if not filename:
+            result.append(None)
+            continue
+        names, data = read_keyed_rows(filename)
+        index = dict((name,i) for i,name in enumerate(names))
+        missing = [key for key in keys if not key in index]
+        if missing:
+            raise RuntimeError, '%s not in %s' % (missing[0],filename)
+        rows = [index[key] for key in keys]
+        data = data[rows]
+        if filename==covariance:
+            data = data[:,rows]
+        result.append(data)
+    return result[0], result[1]
+
+def parse_windows(text):
+    """
+    the fit windows of a scan 'symbol=tmin:tmax,tmin:tmax' as conditions,
+    for every tmin in the first range and every tmax in the second one
+    (ranges are inclusive, of integers)
+
+    >>> print parse_windows('t=2:3,8:9')
+    ['t>=2 and t<=8', 't>=2 and t<=9', 't>=3 and t<=8', 't>=3 and t<=9']
+    """
+    symbol, ranges = text.split('=')
+    bounds = []
+    for item in ranges.split(','):
+        limits = [int(x) for x in item.split(':')]
+        bounds.append(range(limits[0],limits[-1]+1))
+    return ['%s>=%i and %s<=%i' % (symbol.strip(),tmin,symbol.strip(),tmax) \
+                for tmin in bounds[0] for tmax in bounds[1] if tmin<tmax]
+
+def scan_windows(job):
+    """
+    fits the windows (conditions) of one job in sequence, each starting
+    from the result of the previous one (or, if that fails, from the
+    initial values); returns one dict per window, None if its fit failed
+    """
+    conditions, values = job
+    expression, points, symbols, base, setup, priors, initial = \
+        [SHARED[key] for key in ('expression','points','symbols','condition',
+                                 'setup','priors','initial')]
+    rows = []
+    for condition in conditions:
+        fitter = Fitter(expression,points,symbols,'(%s) and (%s)' % (base,condition))
+        setup(fitter)
+        row = None
+        for start in (values, initial):
+            fitter.priors = dict(priors)
+            try:
+                with numpy.errstate(over='ignore',invalid='ignore'):
+                    b, chi2, H = fitter.fit(**start)
+            except (ArithmeticError, LinAlgError):
+                continue
+            errors = numpy.sqrt(numpy.abs(numpy.diag(fitter.covariance)))
+            row = dict(condition=condition,npoints=len(fitter.data),values=b,
+                       errors=dict(zip(fitter.variables,errors.tolist())),chi2=chi2)
+            values = b
+            break
+        rows.append(row)
+    return rows
+
+def scan(expression,points,symbols,conditions,initial_values,
+         condition='True',setup=None,processes=1):
+    """
+    fits the points selected by each of the conditions (and by condition)
+    in one process or, if processes>1, in contiguous groups of windows run
+    in parallel. Each window starts from the result of its neighbour, the
+    first of each group from initial_values. setup(fitter), if given,
+    configures each fitter. Returns one dict per condition with its
+    condition, npoints, values, errors, chi2 and aic (None if failed), where
+    aic = chi2+2*(number of parameters)+2*(number of points not fitted)
+    """
+    initial_values = dict(initial_values)
+    priors = dict((key[1:],(initial_values[key[1:]],initial_values.pop(key))) \
+                      for key in initial_values.keys() if key[0]=='_')
+    ntotal = len(Fitter(expression,points,symbols,condition).data)
+    groups = max(1,min(processes,len(conditions)))
+    size = (len(conditions)+groups-1)//groups
+    jobs = [(conditions[i:i+size],initial_values) \
+                for i in range(0,len(conditions),size)]
+    SHARED.update(expression=expression,points=points,symbols=symbols,
+                  condition=condition,setup=setup or (lambda fitter: None),
+                  priors=priors,initial=initial_values)
+    try:
+        if len(jobs)>1:
+            pool = multiprocessing.Pool(len(jobs))
+            try:
+                results = pool.map(scan_windows,jobs)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = map(scan_windows,jobs)
+    finally:
+        SHARED.clear()
+    rows = [row for rows in results for row in rows]
+    for row in rows:
+        if row:
+            row['aic'] = row['chi2']+2*len(row['values'])+2*(ntotal-row['npoints'])
+    return rows
+
+def model_average(rows):
+    """
+    the averages of the parameters over the fits in rows (from scan),
+    weighted by exp(-aic/2), and their errors, statistical and from the
+    spread between fits; also sets the 'weight' of each row
+    """
+    rows = [row for row in rows if row]
+    aic = numpy.array([row['aic'] for row in rows])
+    weights = numpy.exp(-0.5*(aic-aic.min()))
+    weights /= weights.sum()
+    average = {}
+    for w,row in zip(weights,rows):
+        row['weight'] = w
+    for v in rows[0]['values']:
+        a = numpy.array([row['values'][v] for row in rows])
+        e = numpy.array([row['errors'][v] for row in rows])
+        mean = (weights*a).sum()
+        average[v] = (mean,sqrt((weights*e*e).sum()+(weights*(a-mean)**2).sum()))
+    return average
+
 def test_fitter():
     print 'generating points with z=x*sin(y)+4*y and dz=1'
     points=[[float(x),float(y),1.0*x*sin(y)+4*y-1,x*sin(y)+4*y,x*sin(y)+4*y+1] \
@@ -236,6 +969,7 @@ def test_fitter():
     print 'fitting with a*x*sin(y)+b*y should get a=1, b=4'
     fitter = Fitter("a*x*sin(y)+b*y",points,symbols=['x','y'])
     b, chi2, H = fitter.fit(a=0.0,b=0.0)
+    print "iterations=", fitter.info['iterations']
     print "a=", b['a'], "b=", b['b']
     print "chi2=",chi2
     print "Hessian=",H
@@ -249,6 +983,94 @@ def test_correlated_fitter():
     fitter=Fitter("(a0*(x==0)+a1*(x==1)+a2*(x==2))*sin(y)+b*y",points,
               symbols=['x','y'])
     print fitter.fit(a0=0.0,a1=0.0,a2=0.0,b=0.0)
+    print 'fitting a constant to correlated samples'
+    rng = numpy.random.RandomState(1)
+    samples = numpy.dot(numpy.eye(5)+0.5,rng.normal(size=(5,200)))+2.0
+    points = [[t,s.mean()-s.std(),s.mean(),s.mean()+s.std()] \
+                  for t,s in enumerate(samples)]
+    for method in ('lm','newton'):
+        fitter = Fitter("a+0*x",points,symbols=['x'])
+        fitter.correlate(samples=samples,shrinkage='ledoit-wolf')
+        fitter.method = method
+        b, chi2, H = fitter.fit(a=0.0)
+        C = inv(shrink_covariance(numpy.cov(samples),samples,'ledoit-wolf'))
+        a = C.dot(samples.mean(1)).sum()/C.sum()
+        print method, 'a=', b['a'], 'chi2=', chi2
+        if abs(b['a']-a)>1e-6:
+            raise RuntimeError, 'wrong correlated fit'
+
+def test_bootstrap_fitter():
+    print 'refitting a*x+b on 50 bootstrap samples'
+    rng = numpy.random.RandomState(2)
+    samples = numpy.array([2.0*x+1+0.1*rng.normal(size=50) for x in range(10)])
+    points = [[x,s.mean()-s.std(),s.mean(),s.mean()+s.std()] \
+                  for x,s in enumerate(samples)]
+    fitter = Fitter("a*x+b",points,symbols=['x'])
+    values, chi2, H = fitter.fit(a=0.0,b=0.0)
+    refits = fitter.bootstrap(samples,values)
+    w = 2.0/numpy.array([p[3]-p[1] for p in points])
+    X = numpy.array([[x*wi,wi] for x,wi in enumerate(w)])
+    exact = numpy.linalg.lstsq(X,samples*w.reshape(-1,1),rcond=None)[0].T
+    if numpy.abs(refits[:,:2]-exact).max()>1e-6:
+        raise RuntimeError, 'wrong bootstrap refits'
+    if numpy.any(fitter.bootstrap(samples,values,processes=2)!=refits):
+        raise RuntimeError, 'refits depend on the number of processes'
+    for row in summarize_refits(fitter.variables,values,refits):
+        print '%s = %g [%g, %g] sd=%g' % tuple(row)
+
+def test_multistart():
+    print 'fitting a1*exp(-b1*t)+a2*exp(-b2*t) from 40 latin hypercube starts'
+    points = [[t,y-0.01,y,y+0.01] for t,y in \
+                  [(t,3*exp(-0.2*t)+exp(-0.9*t)) for t in range(20)]]
+    fitter = Fitter("a1*exp(-b1*t)+a2*exp(-b2*t)",points,symbols=['t'])
+    ranges = dict(a1=(0,5),b1=(0,2),a2=(0,5),b2=(0,2))
+    b, chi2, H = fitter.multistart(ranges,dict(a1=1,b1=1,a2=1,b2=1),40,3)
+    print 'a1=',b['a1'],'b1=',b['b1'],'a2=',b['a2'],'b2=',b['b2'],'chi2=',chi2
+    if chi2>1e-6:
+        raise RuntimeError, 'multistart did not find the minimum'
+
+def test_scan():
+    print 'scanning windows of a*exp(-b*t) on 2*exp(-0.5*t)+0.5*exp(-1.5*t)'
+    points = [[t,y*0.99,y,y*1.01] for t,y in \
+                  [(t,2*exp(-0.5*t)+0.5*exp(-1.5*t)) for t in range(16)]]
+    conditions = parse_windows('t=0:8,15:15')
+    rows = scan("a*exp(-b*t)",points,['t'],conditions,dict(a=1.0,b=1.0))
+    for row in rows:
+        print '%-20s b=%.6f chi2=%.3g aic=%.3g' % \
+            (row['condition'],row['values']['b'],row['chi2'],row['aic'])
+    average = model_average(rows)
+    print 'average b=%.6f +- %.6f' % average['b']
+    if abs(average['b'][0]-0.5)>0.01:
+        raise RuntimeError, 'wrong model average'
+    parallel = scan("a*exp(-b*t)",points,['t'],conditions,dict(a=1.0,b=1.0),
+                    processes=3)
+    if max(abs(r['values']['b']-p['values']['b']) for r,p in zip(rows,parallel))>1e-6:
+        raise RuntimeError, 'scan depends on the number of processes'
+
+def summarize_refits(variables,values,refits,percent=0.158):
+    """
+    one row per parameter: name, central value, the lower and upper
+    percentiles and the standard deviation of the refitted values
+    """
+    rows = []
+    for i,v in enumerate(variables):
+        lower, upper = numpy.percentile(refits[:,i],[100*percent,100*(1-percent)])
+        rows.append([v,values[v],lower,upper,refits[:,i].std()])
+    return rows
+
+def parse_bounds(text):
+    """
+    >>> print sorted(parse_bounds('a=0:10,b=:1').items())
+    [('a', (0.0, 10.0)), ('b', (None, 1.0))]
+    """
+    bounds = {}
+    for item in text.split(','):
+        if item.strip():
+            name, limits = item.split('=')
+            lower, upper = limits.split(':')
+            bounds[name.strip()] = (float(lower) if lower.strip() else None,
+                                    float(upper) if upper.strip() else None)
+    return bounds
 
 def main_fitter():
     loc={}
@@ -285,25 +1107,166 @@ def main_fitter():
 		      type='int',dest="ns",
 		      default=1000,
 		      help="number of steps")
+    parser.add_option("-m", "--method",
+		      type='string',dest="method",
+		      default='lm',
+		      help="lm (Levenberg-Marquardt, default) or newton")
+    parser.add_option("-b", "--bounds",
+		      type='string',dest="bounds",
+		      default='',
+		      help="bounds of parameters as in 'a=0:10,b=:1'")
+    parser.add_option("-v", "--verbose",
+		      dest="verbose",action='store_true',
+		      default=False,
+		      help="prints every step of the minimization")
+    parser.add_option("-s", "--samples",
+		      type='string',dest="samples",
+		      default='',
+		      help="bootstrap samples of the points for --refit and --correlated")
+    parser.add_option("-z", "--correlated",
+		      dest="correlated",action='store_true',
+		      default=False,
+		      help="correlated fit with the covariance of --samples")
+    parser.add_option("-k", "--covariance",
+		      type='string',dest="covariance",
+		      default='',
+		      help="covariance matrix of the points for a correlated fit")
+    parser.add_option("-w", "--shrinkage",
+		      type='string',dest="shrinkage",
+		      default='',
+		      help="shrinkage of the correlations: ledoit-wolf (needs --samples)")
+    parser.add_option("-u", "--svdcut",
+		      type='float',dest="svdcut",
+		      default=0.0,
+		      help="raises correlation eigenvalues below svdcut times the largest")
+    parser.add_option("-f", "--refit",
+		      dest="refit",action='store_true',
+		      default=False,
+		      help="refits every bootstrap sample in --samples")
+    parser.add_option("-j", "--processes",
+		      type='int',dest="processes",
+		      default=1,
+		      help="number of processes for --refit and --ranges")
+    parser.add_option("-q", "--percentage",
+		      type='float',dest="percent",
+		      default=0.158,
+		      help="percentage in the lower and upper tails for --refit")
+    parser.add_option("-g", "--ranges",
+		      type='string',dest="ranges",
+		      default='',
+		      help="searches starting values in ranges as in 'a=0:10,b=0:1'")
+    parser.add_option("-N", "--starts",
+		      type='int',dest="starts",
+		      default=100,
+		      help="number of starting values to try in --ranges")
+    parser.add_option("-K", "--keep",
+		      type='int',dest="keep",
+		      default=5,
+		      help="number of best starting values to fit from")
+    parser.add_option("-G", "--grid",
+		      dest="grid",action='store_true',
+		      default=False,
+		      help="starting values on a grid, --starts per range, instead of a latin hypercube")
+    parser.add_option("-S", "--scan",
+		      type='string',dest="scan",
+		      default='',
+		      help="fits all windows as in 't=2:6,12:16' (tmin from 2 to 6, tmax from 12 to 16)")
+    parser.add_option("-W", "--window",
+		      type='string',dest="windows",
+		      default=[],action='append',
+		      help="a condition to be fitted in the scan (can be repeated)")
                       
     options,args=parser.parse_args()
     if options.test:
 	test_fitter()
+	test_correlated_fitter()
+	test_bootstrap_fitter()
+	test_multistart()
+	test_scan()
 	return
     filename=options.input
     expression,initial=args[0].split('@')
-    symbols,points=read_min_mean_max_file(filename)
+    symbols,points,keys=read_min_mean_max_file(filename,keys=True)
+    if options.samples or options.covariance:
+        covariance,samples=read_covariance(keys,options.samples,options.covariance)
+    correlated=options.covariance or options.correlated or \
+        options.shrinkage or options.svdcut
+    if correlated and not (options.samples or options.covariance):
+        raise RuntimeError, 'a correlated fit requires --samples or --covariance'
+    def setup(fitter):
+        if correlated:
+            fitter.correlate(covariance,samples,options.shrinkage,options.svdcut)
+        fitter.ap = options.ap
+        fitter.rp = options.rp
+        fitter.ns = options.ns
+        fitter.method = options.method
+        fitter.verbose = options.verbose
+        fitter.bounds = parse_bounds(options.bounds)
     fitter=Fitter(expression,points,symbols,condition=options.condition)
-    fitter.ap = options.ap
-    fitter.rp = options.rp
-    fitter.ns = options.ns
+    setup(fitter)
     variables=eval('dict(%s)' % initial,loc)
-    variables,chi2,hessian=fitter.fit(**variables)
+    if options.ranges:
+        variables,chi2,hessian=fitter.multistart(
+            parse_bounds(options.ranges),variables,options.starts,
+            options.keep,options.grid,options.processes)
+    else:
+        variables,chi2,hessian=fitter.fit(**variables)
     for key,value in variables.items():
         print '%s = %g' % (key, value)
     print 'chi2=',chi2
     print 'chi2/dof=',chi2/max(len(fitter.data)-len(variables)-1,1)
-    print 'covariance=',inv(hessian)        
+    if fitter.method=='lm':
+        print 'iterations=',fitter.info['iterations'],'(%s)' % fitter.info['message']
+    print 'covariance=',fitter.covariance
+    if options.refit:
+        if not options.samples:
+            raise RuntimeError, '--refit requires --samples'
+        refits=fitter.bootstrap(samples,variables,options.processes)
+        print 'refits=',len(refits),'of',samples.shape[1]
+        prefix=options.input.rsplit('.',1)[0]
+        writer=csv.writer(open(prefix+'.fit_samples.csv','w'),delimiter=',',
+                          quoting=csv.QUOTE_NONNUMERIC)
+        for i,key in enumerate(fitter.variables+['chi2']):
+            writer.writerow([key]+refits[:,i].tolist())
+        writer=csv.writer(open(prefix+'.fit_results.csv','w'),delimiter=',',
+                          quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow([expression,'[min]','[mean]','[max]','[sd]'])
+        for key,value,lower,upper,sd in summarize_refits(
+            fitter.variables,variables,refits,options.percent):
+            print '%s = %g [%g, %g] sd=%g' % (key,value,lower,upper,sd)
+            writer.writerow([key,lower,value,upper,sd])
+        print 'parameter distributions saved in %s.fit_samples.csv' % prefix
+    windows = options.windows+(parse_windows(options.scan) if options.scan else [])
+    if windows:
+        start = dict((k,v) for k,v in eval('dict(%s)' % initial,loc).items() if k[0]=='_')
+        start.update(variables)
+        rows=scan(expression,points,symbols,windows,start,options.condition,
+                  setup,options.processes)
+        if not [row for row in rows if row]:
+            raise ArithmeticError, 'no convergence in any window'
+        average=model_average(rows)
+        names=fitter.variables
+        filename=options.input.rsplit('.',1)[0]+'.scan.csv'
+        writer=csv.writer(open(filename,'w'),delimiter=',',
+                          quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(['[condition]','[points]']+names+['[d%s]' % v for v in names]+
+                        ['[chi2]','[chi2/dof]','[aic]','[weight]'])
+        for condition,row in zip(windows,rows):
+            if not row:
+                print '%-30s no convergence' % condition
+                continue
+            dof=max(row['npoints']-len(names),1)
+            print '%-30s %s chi2/dof=%g weight=%.3g' % (
+                condition,' '.join('%s=%g(%.2g)' % (v,row['values'][v],row['errors'][v]) \
+                                       for v in names),row['chi2']/dof,row['weight'])
+            writer.writerow([condition,row['npoints']]+[row['values'][v] for v in names]+
+                            [row['errors'][v] for v in names]+
+                            [row['chi2'],row['chi2']/dof,row['aic'],row['weight']])
+        writer.writerow(['[average]',''] +[average[v][0] for v in names]+
+                        [average[v][1] for v in names]+['','','',1.0])
+        for v in names:
+            print 'model average %s = %g +- %g' % (v,average[v][0],average[v][1])
+        print 'scan saved in %s' % filename
 
     pointsets = [dict(data=[(p[0],p[-2],0.5*(p[-1]-p[-3])) for p in points])]
     for item in options.extrapolations:
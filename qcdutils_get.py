@@ -25,8 +25,10 @@ Examples:
 
     qcdutils_get.py --test
     qcdutils_get.py --convert ildg gauge.cold.12x8x8x8
+    qcdutils_get.py --convert ildg --seed 1 gauge.hot.12x8x8x8
     qcdutils_get.py --convert mdp --float *.ildg
     qcdutils_get.py --convert split.mdp *.mdp
+    qcdutils_get.py --patch ildg-data-LFN=lfn://my/lfn file.ildg
 
 """
 
@@ -40,14 +42,19 @@ import os
 import re
 import sys
 import time
+import random
+import math
 import datetime
 import optparse
 import struct
 import mmap
 import glob
 import cStringIO
+import cProfile
+import json
 import array
 import fcntl
+import multiprocessing
 import logging
 import traceback
 import shelve
@@ -59,6 +66,11 @@ try:
     HAVE_PROGRESSBAR = True
 except ImportError:
     HAVE_PROGRESSBAR = False
+try:
+    import numpy
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
 
 
 ##### global variables #############################################################
@@ -98,7 +110,7 @@ class Lime(object):
         self.mode = mode
         self.file = open(filename,mode)
         self.records = [] # [(name,position,size)]
-        if mode == 'r' or mode == 'rb':
+        if mode in ('r','rb','r+b'):
             while True:
                 header = self.file.read(144)
                 if not header: break
@@ -131,7 +143,7 @@ class Lime(object):
         >>> lime = Lime('filename','r')
         >>> name, reader, size = lime.read(records = 0)
         """
-        if not self.mode in ('r','rb'):
+        if not self.mode in ('r','rb','r+b'):
             raise RuntimeError, "not suported"
         (name,position,size) = self.records[record]
         self.file.seek(position)
@@ -151,13 +163,15 @@ class Lime(object):
         >>> lime.write('record name','data',size = 4)
         data can be a string or a file object
         """
-        if not self.mode in ('w','wb'):
+        if not self.mode in ('w','wb','r+b'):
             raise RuntimeError, "not supported"
         if isinstance(reader,str):
             if size == None:
                 size = len(reader)
             reader = cStringIO.StringIO(reader)
         # write record header
+        if self.mode == 'r+b':
+            self.file.seek(0,2)
         position = self.file.tell()
         header = struct.pack('!iHHq128s',self.magic,self.version,0,size,name)
         self.file.write(header)
@@ -179,7 +193,40 @@ class Lime(object):
         # add padding bytes
         padding = (8 - (size % 8)) % 8
         self.file.write('\0'*padding)
-        self.records.append((name,size,position))
+        self.records.append((name,position+144,size))
+    def patch(self,name,data):
+        """
+        replaces the content of record name with data (a string) in place
+        >>> lime = Lime('filename','r+b')
+        >>> lime.patch('ildg-data-LFN','lfn://...')
+        if there is no such record it is appended. The data of other records
+        is never touched: the record is rewritten in place if data fits in
+        the space it takes (the tail is filled with zeros) or if it is the
+        last record in the file, else IOError is raised.
+        """
+        if self.mode != 'r+b':
+            raise RuntimeError, "not supported"
+        records = [k for k,record in enumerate(self.records) if record[0] == name]
+        if not records:
+            return self.write(name,data)
+        k = records[-1]
+        (name,position,size) = self.records[k]
+        space = size + (8 - (size % 8)) % 8
+        if k == len(self.records)-1:
+            self.file.truncate(position)
+        elif len(data) > space:
+            raise IOError, "record %s does not fit in place" % name
+        elif len(data) + (8 - (len(data) % 8)) % 8 != space:
+            data = data + '\0'*(space-len(data))
+        self.file.seek(position-144)
+        magic, version, flags, old_size, old_name = \
+            struct.unpack('!iHHq128s',self.file.read(144))
+        self.file.seek(position-144)
+        self.file.write(struct.pack('!iHHq128s',magic,version,flags,
+                                    len(data),old_name))
+        self.file.write(data)
+        self.file.write('\0'*((8 - (len(data) % 8)) % 8))
+        self.records[k] = (name,position,len(data))
     def close(self):
         self.file.close()
     def __len__(self):
@@ -261,6 +308,78 @@ def reorder(data,order1,order2): # data are complex numbers
 
 assert ''.join(reorder('AABBCCDD',[X,Y,Z,T],[Z,Y,X,T])) == 'CCBBAADD'
 
+##### raw (byteswap+gather) conversions ###################################
+
+FASTPATH = True # set to False to force decoding of every number
+
+def timeslice_positions(site_order,nx,ny,nz):
+    """
+    returns a list p such that p[x+nx*(y+ny*z)] is the position of site
+    (x,y,z) within a timeslice stored according to site_order
+    >>> assert timeslice_positions([T,X,Y,Z],2,1,3)[1] == 3
+    """
+    dims = {X:nx,Y:ny,Z:nz}
+    positions = [0]*(nx*ny*nz)
+    for z in xrange(nz):
+        for y in xrange(ny):
+            for x in xrange(nx):
+                coords = {X:x,Y:y,Z:z}
+                i = 0
+                for mu in site_order[1:]:
+                    i = i*dims[mu]+coords[mu]
+                positions[x+nx*(y+ny*z)] = i
+    return positions
+
+assert timeslice_positions([T,X,Y,Z],2,1,3)[1] == 3
+
+def raw_converter(source,target,precision):
+    """
+    if source and target store the same numbers, in the same precision,
+    up to a permutation of sites and links and up to byte order, returns
+    a function that maps the raw bytes of a timeslice of source into the
+    raw bytes of the same timeslice for target. Otherwise returns None.
+    No float is ever decoded: it is only a block byteswap plus a gather.
+    """
+    if not FASTPATH or getattr(source,'offset',None) is None or \
+            getattr(source,'reunitarize',False) or \
+            source.precision != precision or \
+            source.base_size != target.base_size or \
+            source.is_gauge != target.is_gauge:
+        return None
+    (nt,nx,ny,nz) = source.size
+    site_size = source.site_size
+    if source.is_gauge:
+        m = len(source.link_order)
+        links = [source.link_order.index(mu) for mu in target.link_order]
+    else:
+        m, links = 1, [0]
+    block_size = site_size/m
+    source_positions = timeslice_positions(source.site_order,nx,ny,nz)
+    target_positions = timeslice_positions(target.site_order,nx,ny,nz)
+    sites = [None]*len(target_positions)
+    for c,p in enumerate(target_positions):
+        sites[p] = source_positions[c]
+    ranges = []
+    for p in sites:
+        for k in links:
+            i = p*site_size+k*block_size
+            if ranges and ranges[-1][1] == i:
+                ranges[-1][1] = i+block_size
+            else:
+                ranges.append([i,i+block_size])
+    swap = source.endianess != target.endianess
+    identity = (ranges == [[0,len(sites)*site_size]])
+    def convert(data):
+        if swap:
+            items = array.array(precision)
+            items.fromstring(data)
+            items.byteswap()
+            data = items.tostring()
+        if identity:
+            return data
+        return ''.join([data[i:j] for i,j in ranges])
+    return convert
+
 ##### Field readers #############################################################
 
 class QCDFormat(object):
@@ -299,16 +418,41 @@ class QCDFormat(object):
     def read_data(self,t,x,y,z):
         """random access read"""
         return (0,0,0,0,'data')
+    def read_timeslice(self,t):
+        """reads the raw bytes of timeslice t, as stored in the file"""
+        (nt,nx,ny,nz) = self.size
+        size = nx*ny*nz*self.site_size
+        self.file.seek(self.offset+t*size)
+        data = self.file.read(size)
+        if len(data) != size:
+            raise IOError, "file is truncated"
+        return data
     def write_header(self,precision,nt,nx,ny,nz):
         """write header for new file"""
         pass
     def write_data(self,data):
         """write next site variables, in order"""
         pass
+    def write_timeslice(self,data):
+        """writes the raw bytes of the next timeslice"""
+        self.file.write(data)
     def close(self):
         """closes the file"""
         self.file.close()
 
+COLD_SITE = (1.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+             0.0, 0.0, 1.0, 0.0, 0.0, 0.0,
+             0.0, 0.0, 0.0, 0.0, 1.0, 0.0,
+             1.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+             0.0, 0.0, 1.0, 0.0, 0.0, 0.0,
+             0.0, 0.0, 0.0, 0.0, 1.0, 0.0,
+             1.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+             0.0, 0.0, 1.0, 0.0, 0.0, 0.0,
+             0.0, 0.0, 0.0, 0.0, 1.0, 0.0,
+             1.0, 0.0, 0.0, 0.0, 0.0, 0.0,
+             0.0, 0.0, 1.0, 0.0, 0.0, 0.0,
+             0.0, 0.0, 0.0, 0.0, 1.0, 0.0)
+
 class GaugeCold(QCDFormat):
     def __init__(self,nt = 8,nx = 4,ny = 4,nz = 4):
         self.precision = 'f'
@@ -317,19 +461,115 @@ class GaugeCold(QCDFormat):
         (nt,nx,ny,nz) = self.size
         return (self.precision,nt,nx,ny,nz)
     def read_data(self,t,x,y,z):
+        return COLD_SITE
+
+
+def su3_from_rows(a,b):
+    """
+    makes an SU(3) matrix (list of 3 rows of 3 complex numbers) out of
+    the first two rows, by Gram-Schmidt and c = (a^b)*
+    """
+    n = sum(abs(v)**2 for v in a)**0.5
+    a = [v/n for v in a]
+    p = sum(a[i].conjugate()*b[i] for i in range(3))
+    b = [b[i]-p*a[i] for i in range(3)]
+    n = sum(abs(v)**2 for v in b)**0.5
+    b = [v/n for v in b]
+    c = [(a[1]*b[2]-a[2]*b[1]).conjugate(),
+         (a[2]*b[0]-a[0]*b[2]).conjugate(),
+         (a[0]*b[1]-a[1]*b[0]).conjugate()]
+    return [a,b,c]
+
+class GaugeRandom(QCDFormat):
+    """
+    a source of random SU(3) links close to the identity (Gram-Schmidt of
+    1+epsilon*G, with G complex gaussian). A whole timeslice is generated
+    at once from a generator seeded with (seed,t), so the same seed gives
+    the same configuration whatever the order sites are read. Timeslices
+    are produced as raw bytes so every writer can use the fast path.
+    Random numbers always come from random.Random (gaussians by Box-Muller)
+    so a seed gives the same configuration with or without numpy (up to
+    rounding); numpy only speeds up the SU(3) projection.
+    """
+    site_order = [T,Z,Y,X]
+    link_order = [X,Y,Z,T]
+    def __init__(self,nt = 8,nx = 4,ny = 4,nz = 4,seed = 0,epsilon = 0.2,
+                 precision = 'f'):
+        self.precision = precision
+        self.size = (nt,nx,ny,nz)
+        self.seed = seed
+        self.epsilon = epsilon
+        self.endianess = '<' if sys.byteorder == 'little' else '>'
+        self.base_size = 4*9*2
+        self.site_size = self.base_size*(4 if precision == 'f' else 8)
+        self.offset = 0
+        self.t = None
+    def read_header(self):
         (nt,nx,ny,nz) = self.size
-        return [1.0, 0.0, 0.0, 0.0, 0.0, 0.0,
-                0.0, 0.0, 1.0, 0.0, 0.0, 0.0,
-                0.0, 0.0, 0.0, 0.0, 1.0, 0.0,
-                1.0, 0.0, 0.0, 0.0, 0.0, 0.0,
-                0.0, 0.0, 1.0, 0.0, 0.0, 0.0,
-                0.0, 0.0, 0.0, 0.0, 1.0, 0.0,
-                1.0, 0.0, 0.0, 0.0, 0.0, 0.0,
-                0.0, 0.0, 1.0, 0.0, 0.0, 0.0,
-                0.0, 0.0, 0.0, 0.0, 1.0, 0.0,
-                1.0, 0.0, 0.0, 0.0, 0.0, 0.0,
-                0.0, 0.0, 1.0, 0.0, 0.0, 0.0,
-                0.0, 0.0, 0.0, 0.0, 1.0, 0.0]
+        return (self.precision,nt,nx,ny,nz)
+    def read_timeslice(self,t):
+        if t != self.t:
+            (nt,nx,ny,nz) = self.size
+            if HAVE_NUMPY:
+                self.data = self.generate_numpy(t,nx*ny*nz*4)
+            else:
+                self.data = self.generate_python(t,nx*ny*nz*4)
+            self.t = t
+        return self.data
+    def read_data(self,t,x,y,z):
+        (nt,nx,ny,nz) = self.size
+        i = (x+nx*(y+ny*z))*self.site_size
+        return self.unpack(self.read_timeslice(t)[i:i+self.site_size])
+    def close(self):
+        pass
+    def uniforms(self,t,n):
+        """
+        the 12*n uniform random numbers in [0,1) for the n links of
+        timeslice t, two per complex gaussian (Box-Muller)
+        """
+        rng = random.Random((self.seed << 32)+t)
+        r = rng.random
+        return [r() for k in xrange(12*n)]
+    def generate_numpy(self,t,n):
+        """makes n links with numpy, returns their bytes"""
+        u = numpy.array(self.uniforms(t,n)).reshape(n,6,2)
+        r = numpy.sqrt(-2.0*numpy.log(1.0-u[...,0]))
+        phi = 2.0*numpy.pi*u[...,1]
+        z = (r*numpy.cos(phi)+1j*r*numpy.sin(phi)).reshape(n,2,3)
+        if self.epsilon is not None:
+            z = numpy.eye(3)[:2]+self.epsilon*z
+        a = z[:,0]/numpy.sqrt((abs(z[:,0])**2).sum(1))[:,None]
+        b = z[:,1]-(a.conj()*z[:,1]).sum(1)[:,None]*a
+        b = b/numpy.sqrt((abs(b)**2).sum(1))[:,None]
+        c = numpy.cross(a,b).conj()
+        u = numpy.concatenate((a,b,c),1)
+        return u.view(numpy.float64).astype(self.precision).tostring()
+    def generate_python(self,t,n):
+        """makes n links in pure Python, returns their bytes"""
+        u = self.uniforms(t,n)
+        items = array.array(self.precision)
+        for k in xrange(n):
+            g = []
+            for i in xrange(12*k,12*k+12,2):
+                r = math.sqrt(-2.0*math.log(1.0-u[i]))
+                g.append(complex(r*math.cos(2.0*math.pi*u[i+1]),
+                                 r*math.sin(2.0*math.pi*u[i+1])))
+            z = [g[0:3],g[3:6]]
+            if self.epsilon is not None:
+                z = [[(i==j)+self.epsilon*z[i][j] for j in range(3)]
+                     for i in range(2)]
+            for row in su3_from_rows(*z):
+                for v in row:
+                    items.append(v.real)
+                    items.append(v.imag)
+        return items.tostring()
+
+class GaugeHot(GaugeRandom):
+    """
+    a source of Haar random SU(3) links (a hot start), see GaugeRandom
+    """
+    def __init__(self,nt = 8,nx = 4,ny = 4,nz = 4,seed = 0,precision = 'f'):
+        GaugeRandom.__init__(self,nt,nx,ny,nz,seed,None,precision)
 
 
 class GaugeMDP(QCDFormat):
@@ -372,6 +612,24 @@ class GaugeMDP(QCDFormat):
         self.size = (nt,nx,ny,nz)
         self.precision = precision
         self.offset = self.file.tell()
+    def patch_header(self,filename = None,date = None):
+        """
+        rewrites the filename and/or the date strings of the header in place
+        (works for gauge and propagator MDP files alike)
+        """
+        self.file = open(self.filename,'r+b')
+        items = list(struct.unpack(self.header_format,
+                                   self.file.read(self.header_size)))
+        if items[3] != 1325884739:
+            raise IOError, "file not in MDP format"
+        for i,value in ((1,filename),(2,date)):
+            if value is not None:
+                if len(value) > 60:
+                    raise ValueError, "%s is longer than 60 characters" % value
+                items[i] = value
+        self.file.seek(0)
+        self.file.write(struct.pack(self.header_format,*items))
+        self.file.close()
     def read_data(self,t,x,y,z):
         (nt,nx,ny,nz) = self.size
         i = self.offset + (z+nz*(y+ny*(x+nx*t)))*self.site_size
@@ -386,14 +644,18 @@ class GaugeMDP(QCDFormat):
         (precision,nt,nx,ny,nz) = other.read_header()
         notify('  (precision: %s, size: %ix%ix%ix%i)' % (precision,nt,nx,ny,nz))
         self.write_header(target_precision or precision,nt,nx,ny,nz)
-        pbar = ProgressBar(widgets = default_widgets , maxval = self.size[0]).start()
+        convert = raw_converter(other,self,self.precision)
+        pbar = Progress(nt,name = self.filename,unit = 'timeslices').start()
         for t in xrange(nt):
-            for x in xrange(nx):
-                for y in xrange(ny):
-                    for z in xrange(nz):
-                        data = other.read_data(t,x,y,z)
-                        self.write_data(data)
-            pbar.update(t)
+            if convert:
+                self.write_timeslice(convert(other.read_timeslice(t)))
+            else:
+                for x in xrange(nx):
+                    for y in xrange(ny):
+                        for z in xrange(nz):
+                            data = other.read_data(t,x,y,z)
+                            self.write_data(data)
+            pbar.update(t+1)
         pbar.finish()
 
 
@@ -401,18 +663,22 @@ class GaugeMDPSplit(GaugeMDP):
     def convert_from(self,other,target_precision = None):
         (precision,nt,nx,ny,nz) = other.read_header()
         notify('  (precision: %s, size: %ix%ix%ix%i)' % (precision,nt,nx,ny,nz))
-        pbar = ProgressBar(widgets = default_widgets , maxval = nt).start()
+        convert = raw_converter(other,self,target_precision or precision)
+        pbar = Progress(nt,name = self.filename,unit = 'timeslices').start()
         for t in xrange(nt):
             slice = GaugeMDP(self.filename.replace('split.mdp',
                                                    't%.4i.mdp' % t))
             slice.write_header(target_precision or precision,1,nx,ny,nz)
-            for x in xrange(nx):
-                for y in xrange(ny):
-                    for z in xrange(nz):
-                        data = other.read_data(t,x,y,z)
-                        slice.write_data(data)
+            if convert:
+                slice.write_timeslice(convert(other.read_timeslice(t)))
+            else:
+                for x in xrange(nx):
+                    for y in xrange(ny):
+                        for z in xrange(nz):
+                            data = other.read_data(t,x,y,z)
+                            slice.write_data(data)
             slice.close()
-            pbar.update(t)
+            pbar.update(t+1)
         pbar.finish()
 
 
@@ -456,6 +722,7 @@ class PropagatorMDP(QCDFormat):
         self.precision = precision
         self.offset = self.file.tell()
     def read_data(self,t,x,y,z):
+        (nt,nx,ny,nz) = self.size
         i = self.offset + (z+nz*(y+ny*(x+nx*t)))*self.site_size
         self.file.seek(i)
         data = self.file.read(self.site_size)
@@ -468,14 +735,18 @@ class PropagatorMDP(QCDFormat):
         (precision,nt,nx,ny,nz) = other.read_header()
         notify('  (precision: %s, size: %ix%ix%ix%i)' % (precision,nt,nx,ny,nz))
         self.write_header(target_precision or precision,nt,nx,ny,nz)
-        pbar = ProgressBar(widgets = default_widgets , maxval = self.size[0]).start()
+        convert = raw_converter(other,self,self.precision)
+        pbar = Progress(nt,name = self.filename,unit = 'timeslices').start()
         for t in xrange(nt):
-            for x in xrange(nx):
-                for y in xrange(ny):
-                    for z in xrange(nz):
-                        data = other.read_data(t,x,y,z)
-                        self.write_data(data)
-            pbar.update(t)
+            if convert:
+                self.write_timeslice(convert(other.read_timeslice(t)))
+            else:
+                for x in xrange(nx):
+                    for y in xrange(ny):
+                        for z in xrange(nz):
+                            data = other.read_data(t,x,y,z)
+                            self.write_data(data)
+            pbar.update(t+1)
         pbar.finish()
 
 
@@ -508,18 +779,22 @@ class PropagatorMDPSplit(QCDFormat):
     def convert_from(self,other,target_precision = None):
         (precision,nt,nx,ny,nz) = other.read_header()
         notify('  (precision: %s, size: %ix%ix%ix%i)' % (precision,nt,nx,ny,nz))
-        pbar = ProgressBar(widgets = default_widgets , maxval = nt).start()
+        convert = raw_converter(other,self,target_precision or precision)
+        pbar = Progress(nt,name = self.filename,unit = 'timeslices').start()
         for t in xrange(nt):
             slice = PropagatorMDP(self.filename.replace('.split.prop.mdp',
                                                         '.t%.4i.prop.mdp' % t))
             slice.write_header(target_precision or precision,1,nx,ny,nz)
-            for x in xrange(nx):
-                for y in xrange(ny):
-                    for z in xrange(nz):
-                        data = other.read_data(t,x,y,z)
-                        slice.write_data(data)
+            if convert:
+                slice.write_timeslice(convert(other.read_timeslice(t)))
+            else:
+                for x in xrange(nx):
+                    for y in xrange(ny):
+                        for z in xrange(nz):
+                            data = other.read_data(t,x,y,z)
+                            slice.write_data(data)
             slice.close()
-            pbar.update(t)
+            pbar.update(t+1)
         pbar.finish()
 
 
@@ -596,15 +871,19 @@ class GaugeILDG(QCDFormat):
         (precision,nt,nx,ny,nz) = other.read_header()
         notify('  (precision: %s, size: %ix%ix%ix%i)' % (precision,nt,nx,ny,nz))
         self.write_header(target_precision or precision,nt,nx,ny,nz)
-        pbar = ProgressBar(widgets = default_widgets , maxval = self.size[0]).start()
+        convert = raw_converter(other,self,self.precision)
+        pbar = Progress(nt,name = self.filename,unit = 'timeslices').start()
         def reader():
             for t in xrange(nt):
-                for z in xrange(nz):
-                    for y in xrange(ny):
-                        for x in xrange(nx):
-                            data = other.read_data(t,x,y,z)
-                            yield self.pack(data)
-                pbar.update(t)
+                if convert:
+                    yield convert(other.read_timeslice(t))
+                else:
+                    for z in xrange(nz):
+                        for y in xrange(ny):
+                            for x in xrange(nx):
+                                data = other.read_data(t,x,y,z)
+                                yield self.pack(data)
+                pbar.update(t+1)
         self.lime.write('ildg-binary-data',reader(),nt*nx*ny*nz*self.site_size)
         self.lime.write('ildg-data-LFN',self.lfn)
         self.lime.close()
@@ -723,7 +1002,7 @@ class GaugeMILC(QCDFormat):
         (precision,nt,nx,ny,nz) = other.read_header()
         notify('  (precision: %s, size: %ix%ix%ix%i)' % (precision,nt,nx,ny,nz))
         self.write_header(target_precision or precision,nt,nx,ny,nz)
-        pbar = ProgressBar(widgets = default_widgets , maxval = self.size[0]).start()
+        pbar = Progress(nt,name = self.filename,unit = 'timeslices').start()
         def reader():
             for t in xrange(nt):
                 for z in xrange(nz):
@@ -731,7 +1010,7 @@ class GaugeMILC(QCDFormat):
                         for x in xrange(nx):
                             data = other.read_data(t,x,y,z)
                             yield self.pack(data)
-                pbar.update(t)
+                pbar.update(t+1)
 
 class GaugeNERSC(QCDFormat):
     def __init__(self,filename):
@@ -797,7 +1076,107 @@ OPTIONS = {
 
 ALL = (GaugeMDP,GaugeMILC,GaugeNERSC,GaugeILDG,GaugeSCIDAC,PropagatorMDP,PropagatorSCIDAC)
 
-def universal_converter(path,target,precision,convert=True):
+##### profiling #############################################################
+
+def measure_site(args,result):
+    return getattr(args[0],'site_size',None) or 0
+
+def measure_record(args,result):
+    if len(args)>3 and args[3] is not None:
+        return args[3]
+    return isinstance(args[2],str) and len(args[2]) or 0
+
+# (method or function name, stage, how to count bytes)
+INSTRUMENTED = [
+    ('read_header','header',None),
+    ('write_header','header',None),
+    ('read_timeslice','read',lambda a,r: len(r)),
+    ('read_data','read',measure_site),
+    ('unpack','unpack',lambda a,r: len(a[1])),
+    ('reorder','reorder',None),
+    ('check_unitarity','check',None),
+    ('pack','pack',lambda a,r: len(r)),
+    ('write_data','write',measure_site),
+    ('write_timeslice','write',lambda a,r: len(a[1])),
+    ('write','write',measure_record),
+    ('convert_from','other',None),
+    ('md5_for_large_file','checksum',None),
+    ]
+
+class Profiler(object):
+    """
+    accumulates wall time, bytes and calls per stage of the conversion
+    pipeline. Times are exclusive: a stage does not include the time spent
+    in the stages it calls. Nothing is instrumented until enable() is
+    called, so when profiling is off there is no overhead at all.
+    """
+    def __init__(self):
+        self.stats = {} # {stage:[seconds,bytes,calls]}
+        self.stack = []
+        self.patched = []
+    def timed(self,stage,f,measure=None):
+        def g(*a,**b):
+            stack = self.stack
+            stack.append(0.0)
+            t0 = time.time()
+            try:
+                result = f(*a,**b)
+            finally:
+                dt = time.time()-t0
+                children = stack.pop()
+                if stack:
+                    stack[-1] += dt
+                item = self.stats.setdefault(stage,[0.0,0,0])
+                item[0] += dt-children
+                item[2] += 1
+            if measure:
+                item[1] += measure(a,result)
+            return result
+        return g
+    def enable(self):
+        namespace = globals()
+        owners = [Lime]+[c for c in namespace.values() if isinstance(c,type) \
+                             and issubclass(c,QCDFormat)]
+        for name,stage,measure in INSTRUMENTED:
+            for owner in owners:
+                if name in owner.__dict__:
+                    self.patched.append((owner,name,owner.__dict__[name]))
+                    setattr(owner,name,self.timed(stage,owner.__dict__[name],measure))
+            if name in namespace and not isinstance(namespace[name],type):
+                self.patched.append((namespace,name,namespace[name]))
+                namespace[name] = self.timed(stage,namespace[name],measure)
+        def timed_raw_converter(source,target,precision,f=raw_converter):
+            convert = f(source,target,precision)
+            return convert and self.timed('byteswap+gather',convert,
+                                          lambda a,r: len(r))
+        self.patched.append((namespace,'raw_converter',raw_converter))
+        namespace['raw_converter'] = timed_raw_converter
+    def disable(self):
+        while self.patched:
+            owner,name,f = self.patched.pop()
+            if isinstance(owner,dict):
+                owner[name] = f
+            else:
+                setattr(owner,name,f)
+    def report(self):
+        total = sum(item[0] for item in self.stats.values())
+        lines = ['%-16s %10s %6s %12s %10s %10s' % \
+                     ('stage','seconds','%','calls','MB','MB/s')]
+        for stage,(seconds,nbytes,calls) in sorted(self.stats.items(),
+                                                   key=lambda i: -i[1][0]):
+            lines.append('%-16s %10.3f %6.1f %12i %10.2f %10s' % \
+                             (stage,seconds,100.0*seconds/(total or 1),calls,nbytes/1e6,
+                              nbytes and seconds and '%.2f' % (nbytes/1e6/seconds) or ''))
+        lines.append('%-16s %10.3f' % ('total',total))
+        return '\n'.join(lines)
+    def dump(self,filename):
+        data = dict((stage,dict(seconds=seconds,bytes=nbytes,calls=calls)) \
+                        for stage,(seconds,nbytes,calls) in self.stats.items())
+        json.dump(data,open(filename,'w'),indent=2,sort_keys=True)
+
+PROFILER = Profiler()
+
+def universal_converter(path,target,precision,convert=True,cprofile=None):
     filenames = [f for f in glob.glob(path) \
                      if not os.path.basename(f).startswith(CATALOG)]
     if not filenames:
@@ -818,7 +1197,14 @@ def universal_converter(path,target,precision,convert=True):
                     else:
                         dest = option[0](ofilename)
                         source = formatter(filename)
-                        dest.convert_from(source,precision)
+                        if cprofile:
+                            profile = cProfile.Profile()
+                            profile.runcall(dest.convert_from,source,precision)
+                            profile.dump_stats(cprofile)
+                            notify('cProfile stats of %s saved in %s' % (filename,cprofile))
+                            cprofile = None # only one file is profiled
+                        else:
+                            dest.convert_from(source,precision)
                         register_file(ofilename)
                 else: # just pretend and get header info
                     info = formatter(filename).read_header()
@@ -835,6 +1221,39 @@ def universal_converter(path,target,precision,convert=True):
             else:
                 notify('%s .... UNKOWN FORMAT' % filename)
 
+def patch_file(filename,patches):
+    """
+    patches = ['key=value',...] where key is the name of a record for lime
+    files (ildg-data-LFN, scidac-checksum, ...) or filename/date for MDP
+    files. value='@path' reads the value from path.
+    Only headers and metadata records are rewritten, never the binary data.
+    """
+    fields = []
+    for patch in patches:
+        if not '=' in patch:
+            raise ValueError, "invalid patch %s, expected key=value" % patch
+        key, value = patch.split('=',1)
+        if value.startswith('@'):
+            value = open(value[1:],'rb').read()
+        fields.append((key,value))
+    try:
+        lime = Lime(filename,'r+b')
+    except IOError:
+        lime = None
+    if lime:
+        try:
+            for key,value in fields:
+                lime.patch(key,value)
+                notify('%s: patched record %s' % (filename,key))
+        finally:
+            lime.close()
+    else:
+        for key,value in fields:
+            if not key in ('filename','date'):
+                raise KeyError, "MDP header has no field %s" % key
+        GaugeMDP(filename).patch_header(**dict(fields))
+        notify('%s: patched header %s' % (filename,','.join(dict(fields))))
+
 ##### BEGIN PROGRESSBAR ######
 # progressbar  - Text progressbar library for python.
 # Copyright (c) 2005 Nilton Volpato
@@ -1136,12 +1555,12 @@ class ProgressBar(object):
         if self.signal_set:
             signal.signal(signal.SIGWINCH, signal.SIG_DFL)
 
-class ProgressBarDummyy(object):
+class ProgressBarDummy(object):
     def __init__(self, maxval = 100, widgets = default_widgets, 
                  term_width = None, fd = sys.stderr):
         self.nt = maxval
     def update(self, t):
-        notify("completed %s/%s" % (t+1, self.nt))
+        notify("completed %s/%s" % (t, self.nt))
     def start(self):
         notify("starting...")
         return self
@@ -1153,6 +1572,107 @@ if not HAVE_PROGRESSBAR:
 
 ###### END PROGRESSBAR #########
 
+class Progress(object):
+    """
+    progress of a long operation, reported at most every interval seconds:
+    as a ProgressBar if stdout is a terminal, else as one JSON line every
+    log_interval seconds (done, total, rate, eta).
+
+    >>> total = Progress(10**6,name = 'all files').start()
+    >>> pbar = Progress(1000,name = 'file1',parent = total).start()
+    >>> pbar.add(100)
+    >>> pbar.finish() # doctest: +ELLIPSIS
+    {"all": {"done": 100, ...}, "done": 100, ..., "name": "file1", ...}
+    {"done": 100, ..., "name": "all files", ...}
+
+    Every worker thread or process updates only its own slot (slot = k)
+    of the counters, so no lock is needed; with shared = True counters
+    live in shared memory and can be updated by forked processes.
+    Progress made by a child is added to its parent (in slot k modulo the
+    slots of the parent); a parent is drawn, on its own line, every time
+    one of its children finishes.
+    Only the process that created the Progress draws it.
+    """
+    def __init__(self,maxval,name = '',unit = 'bytes',widgets = None,slots = 1,
+                 shared = False,parent = None,interval = 0.5,log_interval = 10.0):
+        self.maxval = max(maxval,1)
+        self.name = name
+        self.unit = unit
+        self.parent = parent
+        self.interval = interval
+        self.log_interval = log_interval
+        self.pid = os.getpid()
+        if shared:
+            self.counters = multiprocessing.RawArray('d',slots)
+        else:
+            self.counters = [0]*slots
+        self.tty = sys.stdout.isatty()
+        self.bar = None
+        if self.tty:
+            self.bar = ProgressBar(widgets = widgets or default_widgets,
+                                   maxval = self.maxval)
+        self.start_time = self.last_time = self.last_log = time.time()
+        self.finished = False
+        self.children = 0
+        if parent:
+            parent.children += 1
+    def value(self):
+        return sum(self.counters)
+    def status(self):
+        done = self.value()
+        elapsed = time.time()-self.start_time
+        rate = done/elapsed if elapsed>0 else 0.0
+        eta = (self.maxval-done)/rate if rate>0 else None
+        return dict(name = self.name,unit = self.unit,done = done,
+                    total = self.maxval,rate = rate,eta = eta,elapsed = elapsed)
+    def start(self):
+        if self.bar:
+            self.bar.start()
+        return self
+    def update(self,value,slot = 0):
+        """sets the progress of slot to value"""
+        self.add(value-self.counters[slot],slot)
+    def add(self,n,slot = 0):
+        """adds n to the progress of slot"""
+        self.counters[slot] += n
+        if self.parent:
+            self.parent.add(n,slot % len(self.parent.counters))
+        self.poll()
+    def poll(self,force = False):
+        now = time.time()
+        if not force and now-self.last_time < self.interval:
+            return
+        if self.finished or os.getpid() != self.pid:
+            return
+        if self.children and not force:
+            return # drawn when a child finishes
+        self.last_time = now
+        if self.bar:
+            self.bar.maxval = max(self.maxval,1)
+            if self.children:
+                self.bar.prev_percentage = -1
+            self.bar.update(min(self.value(),self.bar.maxval))
+            if self.children and not isinstance(self.bar,ProgressBarDummy) \
+                    and not self.bar.finished:
+                self.bar.fd.write('\n') # keeps the line of the parent
+        elif force or now-self.last_log >= self.log_interval:
+            self.last_log = now
+            status = self.status()
+            if self.parent:
+                status['all'] = self.parent.status()
+            sys.stdout.write(json.dumps(status,sort_keys = True)+'\n')
+            sys.stdout.flush()
+    def finish(self):
+        if self.finished:
+            return
+        if self.bar:
+            self.bar.finish()
+        else:
+            self.poll(force = True)
+        self.finished = True
+        if self.parent:
+            self.parent.poll(force = True)
+
 def register_file(path,catalog=CATALOG):
     if not os.path.exists(path):
         return False
@@ -1211,12 +1731,16 @@ def get_list(url):
 
 def download(token,files,target_folder,options):
     notify('total files to download: %s' % len(files))
+    total = Progress(sum(int(f.get('size',0)) for f in files),name = target_folder)
+    if not options.quiet:
+        total.start()
     for k,f in enumerate(files):
         path = f['filename']
         basename = os.path.basename(path)
         target_name = os.path.join(target_folder,basename)
         if file_registered(target_name):
             notify('skipping file %s (already present)' % basename)
+            total.maxval -= int(f.get('size',0))
         else:
             input = None
             widgets = [basename, ' ',Percentage(), ' ', Bar(marker = '#'),' ',
@@ -1234,7 +1758,8 @@ def download(token,files,target_folder,options):
                     notify('unable to retrieve %s retrying in 5 minutes' % basename)
                     time.sleep(5*60)
             if not options.quiet:
-                pbar = ProgressBar(widgets = widgets, maxval = length).start()
+                pbar = Progress(length,name = basename,widgets = widgets,
+                                parent = total).start()
             output = open(target_name,'wb')
             i = 0
             while True:
@@ -1242,7 +1767,7 @@ def download(token,files,target_folder,options):
                 if not data: break
                 output.write(data)
                 i+= len(data)
-                if not options.quiet: pbar.update(i)
+                if not options.quiet: pbar.add(len(data))
             input.close()
             output.close()
             if not options.quiet:
@@ -1252,6 +1777,8 @@ def download(token,files,target_folder,options):
                 notify('completed download: %s/%s' % (k+1,len(files)))
             else:
                 notify('ERROR: file appears truncated')
+    if not options.quiet:
+        total.finish()
 
 def ftp_download(source,target_folder,username,password):
     raise NotImplementedError
@@ -1268,6 +1795,35 @@ def test_conversions():
         assert open('test.zzz.1.mdp','rb').read() == open('test.zzz.3.mdp','rb').read()
         GaugeILDG('test.zzz.2.ildg').convert_from(GaugeILDG('test.zzz.1.ildg'))
         assert open('test.zzz.1.ildg','rb').read() == open('test.zzz.2.ildg','rb').read()
+        patch_file('test.zzz.2.ildg',['ildg-data-LFN=lfn://test/long/name',
+                                      'scidac-checksum=<suma>0</suma>'])
+        patch_file('test.zzz.2.ildg',['ildg-data-LFN=lfn://test'])
+        lime = Lime('test.zzz.2.ildg','rb')
+        assert lime.keys()[-2:] == ['ildg-data-LFN','scidac-checksum']
+        assert lime.read(len(lime)-2)[1].read(9) == 'lfn://tes'
+        lime.close()
+        GaugeMDP('test.zzz.4.mdp').convert_from(GaugeILDG('test.zzz.2.ildg'))
+        assert open('test.zzz.1.mdp','rb').read() == open('test.zzz.4.mdp','rb').read()
+        GaugeMDP('test.zzz.5.mdp').convert_from(GaugeHot(2,4,2,3,seed = 1))
+        GaugeILDG('test.zzz.5.ildg').convert_from(GaugeMDP('test.zzz.5.mdp'))
+        GaugeMDP('test.zzz.6.mdp').convert_from(GaugeILDG('test.zzz.5.ildg'))
+        assert open('test.zzz.5.mdp','rb').read() == open('test.zzz.6.mdp','rb').read()
+        global FASTPATH
+        FASTPATH = False
+        try:
+            GaugeILDG('test.zzz.6.ildg').convert_from(GaugeMDP('test.zzz.5.mdp'))
+            GaugeMDP('test.zzz.7.mdp').convert_from(GaugeRandom(2,4,2,3,seed = 1))
+        finally:
+            FASTPATH = True
+        assert open('test.zzz.5.ildg','rb').read() == open('test.zzz.6.ildg','rb').read()
+        GaugeMDP('test.zzz.8.mdp').convert_from(GaugeRandom(2,4,2,3,seed = 1))
+        if HAVE_NUMPY:
+            # the same seed gives the same links with or without numpy
+            source = GaugeRandom(2,4,2,3,seed = 1,precision = 'd')
+            a = array.array('d',source.generate_numpy(1,10))
+            b = array.array('d',source.generate_python(1,10))
+            assert max(abs(x-y) for x,y in zip(a,b)) < 1e-12
+        assert open('test.zzz.7.mdp','rb').read() == open('test.zzz.8.mdp','rb').read()
         #GaugeMDP('test.zzz.4.mdp').convert_from(GaugeNERSC('demo.nersc'))
         #GaugeILDG('test.zzz.4.ildg').convert_from(GaugeNERSC('demo.nersc'))
         #GaugeMDP('test.zzz.5.mdp').convert_from(GaugeILDG('test.zzz.4.ildg'))
@@ -1305,6 +1861,18 @@ def main():
     parser.add_option("-n", "--noprogressbar",dest = 'noprogressbar',default = False,
                       action = 'store_true',
                       help = "disable progress bar")
+    parser.add_option("-s", "--seed",dest = 'seed',default = 0,type = 'int',
+                      help = "random seed for gauge.hot and gauge.random")
+    parser.add_option("--profile",dest = 'profile',default = False,
+                      action = 'store_true',
+                      help = "prints where the time goes in conversions")
+    parser.add_option("--profile_json",dest = 'profile_json',default = None,
+                      help = "saves the conversion profile in a JSON file")
+    parser.add_option("--cprofile",dest = 'cprofile',default = None,
+                      help = "saves the cProfile stats of the first converted file")
+    parser.add_option("-p", "--patch",dest = 'patch',default = [],
+                      action = 'append',
+                      help = "rewrites a header field or a lime record in place (key=value)")
     (options, args) = parser.parse_args()
 
     ### disable progress bar if necessary
@@ -1324,6 +1892,12 @@ def main():
         print USAGE
         sys.exit(1)
 
+    ### patch headers in place if asked
+    if options.patch:
+        for filename in glob.glob(options.source):
+            patch_file(filename,options.patch)
+        return
+
     ### download data (http, https, ftp, sftp) or not
     infoonly = False
     if options.source.startswith('http://') or options.source.startswith('https://'):
@@ -1357,10 +1931,18 @@ def main():
         infoonly = True
         conversion_path = options.source
 
-    ### if options.source = 'gauge.cold.TxXxYxZ' make it
-    if options.source.startswith('gauge.cold') and not os.path.exists(options.source):
-        size = [int(x) for x in options.source[11:].split('x')]
-        GaugeMDP(options.source).convert_from(GaugeCold(*size))
+    ### if options.source = 'gauge.cold.TxXxYxZ' (or hot, or random) make it
+    match = re.match('gauge\.(cold|hot|random)\.(\d+)x(\d+)x(\d+)x(\d+)$',
+                     options.source)
+    if match and not os.path.exists(options.source):
+        size = [int(x) for x in match.groups()[1:]]
+        if match.group(1) == 'cold':
+            source = GaugeCold(*size)
+        elif match.group(1) == 'hot':
+            source = GaugeHot(*size,seed = options.seed)
+        else:
+            source = GaugeRandom(*size,seed = options.seed)
+        GaugeMDP(options.source).convert_from(source)
 
     ### if conversion required use the universal converter
     if options.convert:
@@ -1368,7 +1950,18 @@ def main():
                    (conversion_path, conversion_path, options.convert))
         precision = 'f' if options.float_precision else \
             'd' if options.double_precision else None
-        universal_converter(conversion_path,options.convert,precision)
+        if options.profile or options.profile_json:
+            PROFILER.enable()
+        try:
+            universal_converter(conversion_path,options.convert,precision,
+                                cprofile=options.cprofile)
+        finally:
+            PROFILER.disable()
+        if options.profile:
+            notify(PROFILER.report())
+        if options.profile_json:
+            PROFILER.dump(options.profile_json)
+            notify('profile saved in %s' % options.profile_json)
     elif infoonly:
         universal_converter(conversion_path,options.convert,
                             precision=None,convert=False)
@@ -114,6 +114,23 @@ def test():
 def clean(text):
     return re.sub('\s+','',text.replace('/','_div_'))
 
+def read_rows(filename):
+    """
+    yields [tag]+values for each row of a csv file saved by qcdutils_boot.py
+    or of its binary version (.bin instead of .csv) if that is newer
+    """
+    binary = filename[:-4]+'.bin'
+    if os.path.exists(binary) and (not os.path.exists(filename) or \
+            os.path.getmtime(binary)>=os.path.getmtime(filename)):
+        from qcdutils_boot import read_columns
+        keys, data = read_columns(binary)
+        for key, row in zip(keys, data):
+            yield [key]+row.tolist()
+    else:
+        for items in csv.reader(open(filename,'r'),
+                                delimiter=',',quoting=csv.QUOTE_NONNUMERIC):
+            yield items
+
 class IPlot:
     def __init__(self,filename,items=[],
                  raw=False,
@@ -127,14 +144,17 @@ class IPlot:
             self.plot_autocorrelations(filename+'_autocorrelations.csv')
         if trails:
             self.plot_trails(filename+'_trails.csv')
+            for name in ('_window_trails','_ewma_trails'):
+                if os.path.exists(filename+name+'.csv') or \
+                        os.path.exists(filename+name+'.bin'):
+                    self.plot_trails(filename+name+'.csv')
 	if bootstrap_samples:
             self.plot_samples(filename+'_samples.csv')
 	self.plot_min_mean_max(filename+'_results.csv',items,plot_range)
 
     def plot_raw_data(self,filename):
         print 'plotting raw data...'
-	for items in csv.reader(open(filename,'r'),
-                                delimiter=',',quoting=csv.QUOTE_NONNUMERIC):
+	for items in read_rows(filename):
             tag = items[0]
             filename2 = filename[:-4]+'_%s.png' % clean(tag)
             print filename2
@@ -150,19 +170,18 @@ class IPlot:
 
     def plot_autocorrelations(self,filename):
         print 'plotting autocorrelations...'
-	for items in csv.reader(open(filename,'r'),
-                                delimiter=',',quoting=csv.QUOTE_NONNUMERIC):
+	for items in read_rows(filename):
             tag = items[0]
+            if tag == '[symbol]': continue # header, then tau_int,dtau_int,window,n_eff
             filename2 = filename[:-4]+'_%s.png' % clean(tag)
             print filename2
-            draw(title='autocorrelation',
-                linesets=[dict(data=[point for point in enumerate(items[1:])])],
+            draw(title='autocorrelation (tau_int=%g)' % items[1],
+                linesets=[dict(data=[point for point in enumerate(items[5:])])],
                 xlab='step',ylab=tag,filename = filename2)
             
     def plot_trails(self,filename):
         print 'plotting moving averages (trails)...'
-	for items in csv.reader(open(filename,'r'),
-                                delimiter=',',quoting=csv.QUOTE_NONNUMERIC):
+	for items in read_rows(filename):
             tag = items[0]
             filename2 = filename[:-4]+'_%s.png' % clean(tag)
             print filename2
@@ -172,8 +191,7 @@ class IPlot:
 
     def plot_samples(self,filename):
         print 'plotting bootstrap samples...'
-	for items in csv.reader(open(filename,'r'),
-                                delimiter=',',quoting=csv.QUOTE_NONNUMERIC):
+	for items in read_rows(filename):
             tag= items[0]
             filename2 = filename[:-4]+'_%s.png' % clean(tag)
             print filename2